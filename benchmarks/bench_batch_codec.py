@@ -0,0 +1,116 @@
+# See LICENSE file for full copyright and licensing details.
+"""Micro-benchmarks of the $batch codec against the previous string based implementation.
+
+Runs without Odoo: python benchmarks/bench_batch_codec.py [--parts 20] [--body-size 50000] [--number 200]
+"""
+import argparse
+import importlib.util
+import json
+import os
+import timeit
+import uuid
+
+BATCH_MODULE = os.path.join(os.path.dirname(__file__), '..', 'office365_framework', 'models', 'batch.py')
+
+
+def load_codec():
+    spec = importlib.util.spec_from_file_location('office365_batch_codec', BATCH_MODULE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+# --------------------------
+# Previous implementation
+# --------------------------
+def legacy_encode(parts, batch_id):
+    body = ""
+
+    for part in parts:
+        body += "--batch_%s\n" % batch_id + part
+
+    body += "--batch_%s--\n\n\n" % batch_id
+
+    return body
+
+
+def legacy_decode(response):
+    responses = [[l for l in r.splitlines() if l != ''] for r in response.split(response.split('\n', 1)[0])[1:]]
+    responses[-1] = responses[-1][:-1]
+
+    return [(int(next(x for x in res if x.startswith("HTTP/1.1"))[9:12]), res[-1]) for res in responses]
+
+
+# ---------
+# Test data
+# ---------
+def make_event(index, body_size):
+    return {
+        'Id': 'AAMkAGI2TG93AAA=%s' % index,
+        'Subject': 'Meeting %s' % index,
+        'Body': {'ContentType': 'Text', 'Content': ('Lorem ipsum dolor sit amet ' * (body_size // 27 + 1))[:body_size]},
+        'Start': {'DateTime': '2020-01-01T10:00:00.0000000', 'TimeZone': 'UTC'},
+        'End': {'DateTime': '2020-01-01T11:00:00.0000000', 'TimeZone': 'UTC'},
+        'Attendees': [{'EmailAddress': {'Address': 'user%s@example.com' % a, 'Name': 'User %s' % a}} for a in range(10)],
+    }
+
+
+def make_response(parts, body_size, pretty):
+    boundary = 'batchresponse_%s' % uuid.uuid4()
+    chunks = []
+
+    for index in range(parts):
+        body = json.dumps(make_event(index, body_size), indent=2 if pretty else None)
+        chunks.append(
+            '--%s\r\nContent-Type: application/http\r\nContent-Transfer-Encoding: binary\r\nContent-ID: %s\r\n\r\n'
+            'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nETag: W/"%s"\r\n\r\n%s\r\n' % (boundary, index + 1, index, body)
+        )
+
+    chunks.append('--%s--\r\n' % boundary)
+
+    return ''.join(chunks)
+
+
+def make_request_parts(codec, parts, body_size):
+    return [codec.encode_batch_request('PATCH', 'https://outlook.office.com/api/v2.0/me/events/%s' % i, json.dumps(make_event(i, body_size))) for i in range(parts)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--parts', type=int, default=20)
+    parser.add_argument('--body-size', type=int, default=50000)
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    codec = load_codec()
+
+    compact = make_response(args.parts, args.body_size, pretty=False)
+    pretty = make_response(args.parts, args.body_size, pretty=True)
+    request_parts = make_request_parts(codec, args.parts, args.body_size)
+    batch_id = uuid.uuid4().hex
+
+    # Correctness: the codec decodes multi-line bodies, the previous implementation only kept their last line
+    decoded = codec.decode_batch(pretty, args.parts)
+    assert [json.loads(p.body)['Id'] for p in decoded] == ['AAMkAGI2TG93AAA=%s' % i for i in range(args.parts)]
+    assert decoded[0].headers.get('etag') == 'W/"0"'
+    assert [json.loads(b)['Id'] for s, b in legacy_decode(compact)] == [json.loads(p.body)['Id'] for p in codec.decode_batch(compact, args.parts)]
+
+    results = [
+        ('encode', 'legacy', lambda: legacy_encode(request_parts, batch_id)),
+        ('encode', 'codec', lambda: codec.encode_batch(request_parts, batch_id)),
+        ('decode compact json', 'legacy', lambda: legacy_decode(compact)),
+        ('decode compact json', 'codec', lambda: codec.decode_batch(compact, args.parts)),
+        ('decode indented json', 'legacy', lambda: legacy_decode(pretty)),
+        ('decode indented json', 'codec', lambda: codec.decode_batch(pretty, args.parts)),
+    ]
+
+    print('%s parts, %s bytes per event body, %s runs' % (args.parts, args.body_size, args.number))
+
+    for name, implementation, func in results:
+        seconds = min(timeit.repeat(func, number=args.number, repeat=3)) / args.number
+        print('%-22s %-7s %10.1f us' % (name, implementation, seconds * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+# See LICENSE file for full copyright and licensing details.
+"""End-to-end benchmark of the calendar synchronisation against the local Outlook stand-in.
+
+Runs inside Odoo, with office365_calendar_sync installed, on a scratch database (users, calendars and events are
+committed, so concurrent workers can see them):
+
+    python benchmarks/bench_sync.py -c odoo.conf -d bench_db [--users 5] [--events 500] [--changed 50] [--workers 1]
+
+Scenarios: initial pull, delta pull, delta pull after Outlook expired the delta tokens (410) and push.
+
+Reports per scenario the events per second, API calls per event, wall time and peak python memory.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fake_outlook import FakeOutlook, start_server, API_PREFIX, TOKEN_PATH
+
+
+class Scenario:
+    def __init__(self, name, service):
+        self.name = name
+        self.service = service
+        self.items = 0
+
+    def __enter__(self):
+        self.service.reset_counters()
+        tracemalloc.start()
+        self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.wall = time.perf_counter() - self.start
+        self.peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        if exc_type is None:
+            self.report()
+
+    def report(self):
+        counter = self.service.counter
+        items = self.items or 1
+
+        print('%-22s %7s items %8.2f s %9.1f items/s %6.2f calls/item %6.2f batch parts/item %5s throttled %5s gone %8.1f MiB peak %8.1f KiB sent' % (
+            self.name, self.items, self.wall, self.items / self.wall if self.wall else 0, counter['http'] / items,
+            counter['batch part'] / items, counter['throttled'], counter['gone'], self.peak / 2 ** 20, counter['bytes'] / 2 ** 10))
+
+
+def bootstrap_odoo(config, database):
+    import odoo
+
+    odoo.tools.config.parse_config(['-c', config, '-d', database] if config else ['-d', database])
+
+    return odoo, odoo.registry(database)
+
+
+def point_to_service(base_url):
+    from odoo.addons.office365_framework.models.user import azure_ad_user
+
+    azure_ad_user.OUTLOOK_ENDPOINT = base_url + API_PREFIX
+    azure_ad_user.AZURE_AD_TOKEN_ENDPOINT = base_url + TOKEN_PATH
+
+
+def create_users(env, service, args, run_id):
+    users = env['azure.ad.user']
+
+    for index in range(args.users):
+        email = 'bench%s-%s@example.com' % (index, run_id)
+        mailbox = service.add_mailbox(email, events=args.events, series_every=args.series_every)
+
+        partner = env['res.partner'].create({'name': 'Bench %s' % index, 'email': email})
+        user = env['azure.ad.user'].create({
+            'partner_id': partner.id,
+            'email': email,
+            'oauth_client_id': 'bench',
+            'oauth_client_secret': 'bench',
+            'refresh_token': 'refresh:%s' % email,
+        })
+        user.set_access_token()
+
+        user.calendar_id = env['azure.ad.calendar'].create({'azure_ad_user_id': user.id, 'uid': mailbox.calendar_id, 'name': 'Calendar'})
+        user.azure_ad_sync_started = True
+
+        users |= user
+
+    return users
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-c', '--config', default=None)
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--events', type=int, default=500, help='Events per mailbox')
+    parser.add_argument('--series-every', type=int, default=10, help='Every nth event is a series with 4 occurrences')
+    parser.add_argument('--changed', type=int, default=50, help='Events changed per mailbox, in Outlook and in Odoo')
+    parser.add_argument('--workers', type=int, default=1, help='Value of office365.sync.workers')
+    parser.add_argument('--throttle-every', type=int, default=0, help='Answer every nth request of a mailbox with 429')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every HTTP request')
+    args = parser.parse_args()
+
+    odoo, registry = bootstrap_odoo(args.config, args.database)
+
+    service = FakeOutlook(throttle_every=args.throttle_every, latency=args.latency)
+    server, base_url = start_server(service)
+    point_to_service(base_url)
+
+    run_id = uuid.uuid4().hex[:8]
+
+    print('%s users, %s events per mailbox, %s changed, %s workers, fake Outlook on %s' % (args.users, args.events, args.changed, args.workers, base_url))
+
+    with odoo.api.Environment.manage(), registry.cursor() as cr:
+        env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+        env['ir.config_parameter'].set_param('office365.sync.workers', args.workers)
+
+        users = create_users(env, service, args, run_id)
+        cr.commit()
+
+        # Outlook -> Odoo, first pull of every calendar
+        with Scenario('initial pull', service) as scenario:
+            for user in users:
+                scenario.items += env['azure.ad.pull.queue.item'].pull_for_user(user.id)
+
+            env['azure.ad.change.queue.item'].process_queue()
+            cr.commit()
+
+        # Outlook -> Odoo, delta pull of the changed events of all users
+        for user in users:
+            service.touch_events(user.email, args.changed)
+
+        with Scenario('delta pull', service) as scenario:
+            env['azure.ad.pull.queue.item'].process_for_all_users()
+            cr.commit()
+
+            scenario.items = args.changed * len(users)
+
+        # Outlook -> Odoo, delta tokens expired by Outlook, every calendar answers 410 and is pulled in full again
+        service.expire_deltas()
+
+        with Scenario('expired delta pull', service) as scenario:
+            env['azure.ad.pull.queue.item'].process_for_all_users()
+            cr.commit()
+
+            scenario.items = sum(len(service.mailboxes[user.email].events) for user in users)
+
+        # Odoo -> Outlook, changes of linked events pushed through the change and push queues
+        links = env['azure.ad.user.record.link'].search([('user_id', 'in', users.ids), ('record', '!=', False)])
+        records = links.mapped('record')[:args.changed * len(users)]
+
+        for record in records:
+            record.write({'name': 'Changed in Odoo %s' % record.id})
+
+        cr.commit()
+
+        with Scenario('push', service) as scenario:
+            scenario.items = len(records)
+
+            env['azure.ad.change.queue.item'].process_queue()
+            env['azure.ad.push.queue.item'].process_queue()
+            cr.commit()
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,479 @@
+# See LICENSE file for full copyright and licensing details.
+"""Local stand-in for the Office 365 endpoints used by office365_framework and office365_calendar_sync.
+
+Serves the token endpoint, calendargroups, calendars, calendarview with delta/nextLink/410 behaviour, events,
+$batch, subscriptions and 429 responses with Retry-After. Counts every request, so benchmarks can report
+API calls per event. Runs without Odoo:
+
+    python benchmarks/fake_outlook.py --port 8765 --users 5 --events 200 [--delta-ttl 600]
+
+Delta tokens expire after --delta-ttl seconds, or on POST /fake/expire-deltas[?email=<email>], after which
+calendarview answers 410 SyncStateNotFound for them.
+"""
+import argparse
+import base64
+import gzip
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+API_PREFIX = '/api/v2.0/me/'
+TOKEN_PATH = '/common/oauth2/v2.0/token'
+EXPIRE_DELTAS_PATH = '/fake/expire-deltas'
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+DEFAULT_PAGE_SIZE = 200
+
+
+def encode_jwt(payload):
+    def part(data):
+        return base64.b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+    return '%s.%s.%s' % (part({'typ': 'JWT', 'alg': 'none'}), part(payload), 'signature')
+
+
+def status_line(status):
+    """Returns the HTTP status line of a status code, with its reason phrase"""
+    try:
+        return 'HTTP/1.1 %s %s' % (status, HTTPStatus(status).phrase)
+    except ValueError:
+        return 'HTTP/1.1 %s Unknown' % status
+
+
+class FakeMailbox:
+    def __init__(self, email, tenant):
+        self.email = email
+        self.tenant = tenant
+        self.calendar_id = 'cal-%s' % email
+        self.events = {}
+        self.deleted = {}
+        self.version = 0
+        self.oldest_delta = 0
+        self.delta_times = {}
+        self.requests = 0
+        self.lock = threading.RLock()
+
+    def next_version(self):
+        self.version += 1
+        return self.version
+
+    def expire_deltas(self):
+        """Invalidates every delta token handed out so far, as Outlook does with old sync states"""
+        with self.lock:
+            self.oldest_delta = self.next_version()
+            self.delta_times.clear()
+
+    def issue_delta(self, version):
+        """Returns the delta token of version, remembers when it was handed out for the delta ttl"""
+        with self.lock:
+            self.delta_times.setdefault(version, time.time())
+
+        return version
+
+    def is_delta_expired(self, version, ttl):
+        """Returns whether a delta token is no longer valid, tokens older than ttl seconds expire all tokens of the mailbox"""
+        with self.lock:
+            if version < self.oldest_delta:
+                return True
+
+            issued = self.delta_times.get(version)
+
+            if ttl and issued is not None and issued + ttl < time.time():
+                self.expire_deltas()
+
+                return True
+
+            return False
+
+    def add_event(self, event):
+        with self.lock:
+            event['_version'] = self.next_version()
+            event['LastModifiedDateTime'] = datetime.utcnow().strftime(DATETIME_FORMAT) + '.0000000Z'
+            self.events[event['Id']] = event
+            self.deleted.pop(event['Id'], None)
+
+        return event
+
+    def update_event(self, event_id, changes):
+        with self.lock:
+            event = self.events[event_id]
+
+            for key, value in changes.items():
+                if isinstance(value, dict) and isinstance(event.get(key), dict):
+                    event[key] = dict(event[key], **value)
+                else:
+                    event[key] = value
+
+            return self.add_event(event)
+
+    def delete_event(self, event_id):
+        with self.lock:
+            self.events.pop(event_id)
+            self.deleted[event_id] = self.next_version()
+
+    def changes_since(self, version):
+        with self.lock:
+            changed = [e for e in self.events.values() if e['_version'] > version]
+            removed = [{
+                '@odata.type': '#Microsoft.OutlookServices.Event',
+                'id': "Users('%s')/CalendarView('%s')" % (self.email, event_id),
+                'reason': 'deleted',
+            } for event_id, v in self.deleted.items() if v > version]
+
+            # SeriesMasters last, so occurrences regularly need a master from another page
+            changed.sort(key=lambda e: (e['Type'] == 'SeriesMaster', e['_version'], e['Id']))
+
+            return changed + removed, self.version
+
+
+class FakeOutlook:
+    """State of the fake service, shared by all request handler threads"""
+
+    def __init__(self, throttle_every=0, retry_after=1, latency=0.0, delta_ttl=0):
+        self.mailboxes = {}
+        self.delta_ttl = delta_ttl
+        self.tokens = {}
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.latency = latency
+        self.counter = Counter()
+        self.lock = threading.Lock()
+
+    # -----
+    # Setup
+    # -----
+    def add_mailbox(self, email, events=0, series_every=0, occurrences=4, tenant='fake-tenant'):
+        mailbox = self.mailboxes[email] = FakeMailbox(email, tenant)
+        start = datetime.utcnow().replace(minute=0, second=0, microsecond=0) + timedelta(days=1)
+
+        for index in range(events):
+            if series_every and index % series_every == 0:
+                self.add_series(mailbox, index, start + timedelta(hours=index), occurrences)
+            else:
+                mailbox.add_event(self.make_event(mailbox, 'evt-%s-%s' % (email, index), start + timedelta(hours=index)))
+
+        return mailbox
+
+    def add_series(self, mailbox, index, start, occurrences):
+        master_id = 'ser-%s-%s' % (mailbox.email, index)
+        master = self.make_event(mailbox, master_id, start, event_type='SeriesMaster')
+        mailbox.add_event(master)
+
+        for occurrence in range(occurrences):
+            event = self.make_event(mailbox, '%s-occ-%s' % (master_id, occurrence), start + timedelta(days=7 * occurrence), event_type='Occurrence')
+            event['SeriesMasterId'] = master_id
+            event['iCalUId'] = master['iCalUId']
+            mailbox.add_event(event)
+
+    def make_event(self, mailbox, event_id, start, event_type='SingleInstance', body_size=2000):
+        return {
+            'Id': event_id,
+            'Type': event_type,
+            'iCalUId': 'ical-%s' % event_id,
+            'Categories': ['Odoo'],
+            'Subject': 'Meeting %s' % event_id,
+            'Body': {'ContentType': 'Text', 'Content': ('Agenda of the meeting. ' * (body_size // 23 + 1))[:body_size]},
+            'BodyPreview': 'Agenda of the meeting.',
+            'Start': {'DateTime': start.strftime(DATETIME_FORMAT) + '.0000000', 'TimeZone': 'UTC'},
+            'End': {'DateTime': (start + timedelta(minutes=30)).strftime(DATETIME_FORMAT) + '.0000000', 'TimeZone': 'UTC'},
+            'IsAllDay': False,
+            'Location': {'DisplayName': 'Room 1'},
+            'Organizer': {'EmailAddress': {'Address': mailbox.email, 'Name': mailbox.email}},
+            'Attendees': [{'EmailAddress': {'Address': 'attendee%s@example.com' % a, 'Name': 'Attendee %s' % a}, 'Status': {'Response': 'None'}} for a in range(3)],
+            'ReminderMinutesBeforeStart': 15,
+            'ResponseStatus': {'Response': 'Organizer', 'Time': '0001-01-01T00:00:00Z'},
+            'WebLink': 'https://outlook.office365.com/owa/?itemid=%s' % event_id,
+            'SeriesMasterId': None,
+        }
+
+    def expire_deltas(self, email=None):
+        """Invalidates the delta tokens of a mailbox, or of all mailboxes, their next delta pull gets a 410"""
+        for mailbox in ([self.mailboxes[email]] if email else list(self.mailboxes.values())):
+            mailbox.expire_deltas()
+
+    def touch_events(self, email, amount):
+        """Changes the subject of amount events of a mailbox, as if edited in Outlook"""
+        mailbox = self.mailboxes[email]
+
+        for event_id in list(mailbox.events)[:amount]:
+            mailbox.update_event(event_id, {'Subject': 'Changed %s' % uuid.uuid4().hex[:8]})
+
+    # ----------
+    # Statistics
+    # ----------
+    def count(self, key, amount=1):
+        with self.lock:
+            self.counter[key] += amount
+
+    def reset_counters(self):
+        with self.lock:
+            self.counter.clear()
+
+    # --------
+    # Requests
+    # --------
+    def get_token(self, form):
+        email = form.get('refresh_token') or form.get('code') or ''
+        email = email.split(':', 1)[-1]
+
+        if email not in self.mailboxes:
+            return 400, {'error': 'invalid_grant'}, {}
+
+        mailbox = self.mailboxes[email]
+        expires = int(time.time()) + 3600
+        access_token = encode_jwt({'upn': email, 'exp': expires, 'nonce': uuid.uuid4().hex})
+        self.tokens[access_token] = email
+
+        return 200, {
+            'token_type': 'Bearer',
+            'expires_in': 3600,
+            'access_token': access_token,
+            'refresh_token': 'refresh:%s' % email,
+            'id_token': encode_jwt({'preferred_username': email, 'tid': mailbox.tenant, 'exp': expires}),
+        }, {}
+
+    def handle(self, method, url, headers, body):
+        """Handles one API request, also used for the parts of a $batch request. Returns status, body, headers"""
+        email = self.tokens.get((headers.get('Authorization') or '').replace('Bearer ', ''))
+
+        if not email:
+            return 401, {'error': {'code': 'InvalidAuthenticationToken'}}, {}
+
+        mailbox = self.mailboxes[email]
+        parts = urlsplit(url)
+        path = unquote(parts.path)[len(API_PREFIX):] if parts.path.startswith(API_PREFIX) else unquote(parts.path).lstrip('/')
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+
+        with mailbox.lock:
+            mailbox.requests += 1
+            throttled = self.throttle_every and mailbox.requests % self.throttle_every == 0
+
+        if throttled:
+            self.count('throttled')
+            return 429, {'error': {'code': 'ApplicationThrottled'}}, {'Retry-After': str(self.retry_after)}
+
+        self.count('%s %s' % (method, re.sub(r'/[^/]+-[^/]+', '/{id}', path.split('?')[0])))
+
+        if method == 'POST' and path == '$batch':
+            return self.handle_batch(headers, body)
+
+        data = json.loads(body) if body else {}
+        select = query.get('$select')
+
+        if path == 'calendargroups':
+            return 200, {'value': [{'Id': 'group-%s' % email, 'Name': 'My Calendars'}]}, {}
+
+        match = re.match(r'^calendargroups/([^/]+)/calendars$', path)
+        if match:
+            return 200, {'value': [{'Id': mailbox.calendar_id, 'Name': 'Calendar'}]}, {}
+
+        match = re.match(r'^calendars/([^/]+)/calendarview$', path)
+        if match:
+            return self.handle_calendar_view(mailbox, match.group(1), query, headers, select)
+
+        match = re.match(r'^calendars/([^/]+)/events$', path)
+        if match and method == 'POST':
+            event = dict(self.make_event(mailbox, 'evt-%s-%s' % (email, uuid.uuid4().hex), datetime.utcnow()), **data)
+            event['Organizer'] = {'EmailAddress': {'Address': email, 'Name': email}}
+            return 201, self.project(mailbox.add_event(event), None), {}
+
+        match = re.match(r'^calendars/([^/]+)$', path)
+        if match:
+            if match.group(1) != mailbox.calendar_id:
+                return 404, {'error': {'code': 'ErrorItemNotFound'}}, {}
+            return 200, {'Id': mailbox.calendar_id, 'Name': 'Calendar'}, {}
+
+        match = re.match(r'^events/([^/]+)$', path)
+        if match:
+            event_id = match.group(1)
+
+            if event_id not in mailbox.events:
+                return 404, {'error': {'code': 'ErrorItemNotFound'}}, {}
+            if method == 'GET':
+                return 200, self.project(mailbox.events[event_id], select), {}
+            if method == 'PATCH':
+                return 200, self.project(mailbox.update_event(event_id, data), None), {}
+            if method == 'DELETE':
+                mailbox.delete_event(event_id)
+                return 204, '', {}
+
+        if path == 'subscriptions' and method == 'POST':
+            return 201, dict(data, Id='sub-%s' % uuid.uuid4().hex), {}
+
+        if path.startswith('subscriptions/'):
+            return (200, dict(data, Id=path.split('/')[1]), {}) if method == 'PATCH' else (204, '', {})
+
+        return 400, {'error': {'code': 'ErrorInvalidUrl', 'message': '%s %s' % (method, path)}}, {}
+
+    def handle_calendar_view(self, mailbox, calendar_id, query, headers, select):
+        if calendar_id != mailbox.calendar_id:
+            return 404, {'error': {'code': 'ErrorItemNotFound'}}, {}
+
+        delta_token = query.get('$deltaToken') or query.get('$deltatoken')
+        since = int(delta_token) if delta_token else 0
+
+        if delta_token and mailbox.is_delta_expired(since, self.delta_ttl):
+            self.count('gone')
+            return 410, {'error': {'code': 'SyncStateNotFound'}}, {}
+
+        page_size = DEFAULT_PAGE_SIZE
+        match = re.search(r'odata\.maxpagesize=(\d+)', headers.get('Prefer') or '')
+        if match:
+            page_size = int(match.group(1))
+
+        changes, version = mailbox.changes_since(since)
+        skip = int(query.get('$skipToken') or 0)
+        page = changes[skip:skip + page_size]
+
+        base = 'http://%s%scalendars/%s/calendarview?startDateTime=%s&endDateTime=%s' % (headers.get('Host'), API_PREFIX, calendar_id, query.get('startDateTime'), query.get('endDateTime'))
+        if select:
+            base += '&$select=%s' % select
+        if delta_token:
+            base += '&$deltaToken=%s' % delta_token
+
+        result = {'value': [self.project(e, select) if 'Id' in e else e for e in page]}
+
+        if skip + page_size < len(changes):
+            result['@odata.nextLink'] = '%s&$skipToken=%s' % (base, skip + page_size)
+        else:
+            result['@odata.deltaLink'] = re.sub(r'&\$deltaToken=[^&]*', '', base) + '&$deltaToken=%s' % mailbox.issue_delta(version)
+
+        return 200, result, {}
+
+    def handle_batch(self, headers, body):
+        boundary = re.search(r'boundary=(\S+)', headers.get('Content-Type') or '').group(1)
+        response_boundary = 'batchresponse_%s' % uuid.uuid4()
+        chunks = []
+
+        for content_id, method, url, part_body in self.parse_batch(body, boundary):
+            self.count('batch part')
+            status, data, part_headers = self.handle(method, url, headers, part_body)
+            payload = json.dumps(data) if data != '' else ''
+            extra = ''.join('%s: %s\r\n' % h for h in part_headers.items())
+
+            chunks.append('--%s\r\nContent-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n%s\r\n%s\r\nContent-Type: application/json\r\n%s\r\n%s\r\n' % (
+                response_boundary, 'Content-ID: %s\r\n' % content_id if content_id else '', status_line(status), extra, payload))
+
+        chunks.append('--%s--\r\n' % response_boundary)
+
+        return 200, ''.join(chunks), {'Content-Type': 'multipart/mixed; boundary=%s' % response_boundary}
+
+    @staticmethod
+    def parse_batch(body, boundary):
+        for part in body.split('--%s' % boundary)[1:]:
+            if part.startswith('--'):
+                break
+
+            mime, _sep, http = part.lstrip('\r\n').partition('\n\n')
+            content_id = re.search(r'Content-ID: *<?([^>\s]+)', mime)
+            request_line, _sep, rest = http.lstrip('\r\n').partition('\n')
+            method, url = request_line.split(' ')[:2]
+            _headers, _sep, part_body = rest.partition('\n\n')
+
+            yield content_id.group(1) if content_id else None, method, url, part_body.strip()
+
+    @staticmethod
+    def project(event, select):
+        event = {k: v for k, v in event.items() if not k.startswith('_')}
+
+        if select:
+            fields = set(select.split(',')) | {'Id'}
+            event = {k: v for k, v in event.items() if k in fields}
+
+        return event
+
+
+class FakeOutlookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    service = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode() if length else ''
+
+        self.service.count('http')
+
+        if self.service.latency:
+            time.sleep(self.service.latency)
+
+        if self.path.startswith(TOKEN_PATH):
+            status, data, headers = self.service.get_token({k: v[0] for k, v in parse_qs(body).items()})
+        elif self.path.startswith(EXPIRE_DELTAS_PATH) and self.command == 'POST':
+            email = parse_qs(urlsplit(self.path).query).get('email', [None])[0]
+
+            if email and email not in self.service.mailboxes:
+                status, data, headers = 404, {'error': {'code': 'ErrorItemNotFound'}}, {}
+            else:
+                self.service.expire_deltas(email)
+                status, data, headers = 204, '', {}
+        else:
+            status, data, headers = self.service.handle(self.command, self.path, self.headers, body)
+
+        payload = (data if isinstance(data, str) else json.dumps(data)).encode()
+        headers.setdefault('Content-Type', 'application/json')
+
+        if 'gzip' in (self.headers.get('Accept-Encoding') or '') and len(payload) > 1024:
+            payload = gzip.compress(payload)
+            headers['Content-Encoding'] = 'gzip'
+
+        self.service.count('bytes', len(payload))
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = do_request
+
+
+def start_server(service, host='127.0.0.1', port=0):
+    """Starts the fake service in a background thread, returns the server and its base url"""
+    handler = type('BoundFakeOutlookHandler', (FakeOutlookHandler,), {'service': service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, 'http://%s:%s' % server.server_address
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--users', type=int, default=1)
+    parser.add_argument('--events', type=int, default=100)
+    parser.add_argument('--series-every', type=int, default=10)
+    parser.add_argument('--throttle-every', type=int, default=0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--delta-ttl', type=float, default=0, help='Seconds after which delta tokens expire, 0 never')
+    args = parser.parse_args()
+
+    service = FakeOutlook(throttle_every=args.throttle_every, retry_after=args.retry_after, delta_ttl=args.delta_ttl)
+
+    for index in range(args.users):
+        service.add_mailbox('user%s@example.com' % index, events=args.events, series_every=args.series_every)
+
+    server, url = start_server(service, args.host, args.port)
+    print('Fake Outlook listening on %s, refresh tokens are refresh:<email>' % url)
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
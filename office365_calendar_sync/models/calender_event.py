@@ -14,7 +14,7 @@ class CalendarEvent(models.Model):
     _inherit = ['calendar.event', 'azure.ad.change.queuer']
 
     # Outlook owner is char field instead of direct reference to azure users, because it is not necessarily created by a user in Odoo
-    outlook_ical_uid = fields.Char(string='Outlook unique iCalUID')
+    outlook_ical_uid = fields.Char(string='Outlook unique iCalUID', index=True)
     outlook_owner_email = fields.Char(string='Owner of the event in Outlook')
     from_outlook = fields.Boolean(string='Created from an event in Outlook')
 
@@ -115,7 +115,7 @@ class CalendarEvent(models.Model):
     
                 if azure_ad_user_id:
                     # No link yet
-                    if not azure_ad_user_id.record_link_ids.filtered(lambda r: r.record._name == record._name and r.record.id == record.id):
+                    if not self.env['azure.ad.user.record.link'].sudo().search_count(self.env['azure.ad.user.record.link'].get_reference_domain(record) + [('user_id', '=', azure_ad_user_id.id)]):
                         try:
                             ad_event.categories = list(set(ad_event.categories + [azure_ad_user_id.outlook_category]))
     
@@ -152,6 +152,26 @@ class CalendarEvent(models.Model):
     def get_change_observed_values(self):
         return ['id', 'name', 'description', 'start', 'stop', 'allday', 'location', 'partner_ids', 'outlook_categories']
 
-    
-    def get_record_link_domain(self):
-        return ['|', ('record', '=', '%s,%s' % (self._name, self.id)), ('record', '=like', '%s,%s-%%' % (self._name, self.id))]
+    def get_sync_hash(self):
+        self.ensure_one()
+
+        # Attendees of events created in Odoo are sent in the body, they are not synced back
+        return AzureADEvent.compute_sync_hash(
+            self.name, self.description, fields.Datetime.to_string(self.start), fields.Datetime.to_string(self.stop), self.allday, self.location,
+            self.sudo().partner_ids.mapped('email') if self.from_outlook else None, json.loads(self.outlook_categories) if self.outlook_categories else [],
+        )
+
+    def get_pushed_link_values(self, vals):
+        res = super(CalendarEvent, self).get_pushed_link_values(vals)
+
+        # Attendees pushed from Odoo, the next pull resolves the attendees of Outlook again
+        if 'partner_ids' in vals:
+            res['attendee_hash'] = False
+
+        return res
+
+    def get_sync_hash_fields(self):
+        self.ensure_one()
+
+        return ['name', 'description', 'start', 'stop', 'allday', 'location', 'outlook_categories'] + (['partner_ids'] if self.from_outlook else [])
+
@@ -1,12 +1,17 @@
 # See LICENSE file for full copyright and licensing details.
 import json
 import re
+import threading
 import traceback
 from datetime import datetime, timedelta
 
 from odoo import api, fields, models, _
 from odoo.tools import DEFAULT_SERVER_DATETIME_FORMAT, logging
 
+from odoo.addons.office365_framework.models.cache import LRUCache
+from odoo.addons.office365_framework.models.concurrency import is_concurrent_pull, lock_creation, fetch_committed
+from odoo.addons.office365_framework.models.exceptions import NotFoundError, ConcurrentCreationError
+
 from .azure_ad_event import AzureADEvent
 from . import DATETIME_FORMAT
 
@@ -23,6 +28,16 @@ EVENTS_DATA_DOMAIN = 'events/%s'
 
 CALENDAR_CALENDAR_VIEW_DOMAIN = 'calendars/%s/calendarview'
 
+# Properties read by get_events_from_page, other properties are not requested
+EVENT_SELECT_FIELDS = [
+    'Id', 'Type', 'SeriesMasterId', 'iCalUId', 'Categories', 'Subject', 'Body', 'Start', 'End', 'IsAllDay',
+    'Location', 'Organizer', 'Attendees', 'ReminderMinutesBeforeStart', 'LastModifiedDateTime',
+]
+CALENDAR_SELECT_FIELDS = ['Id', 'Name']
+
+# SeriesMasters per (database, user, master id), kept between pulls of the worker
+_series_master_cache = LRUCache(max_size=4096, ttl=86400)
+
 
 class AzureADCalendar(models.Model):
     _name = 'azure.ad.calendar'
@@ -32,6 +47,7 @@ class AzureADCalendar(models.Model):
     uid = fields.Char(string='Unique Calendar Id')
     name = fields.Char(string='Name')
     delta_token = fields.Char(string='Delta Token')
+    sync_link = fields.Char(string='Sync Checkpoint', help='Link to the next page of an interrupted pull, the next pull resumes from it')
 
     def to_azure_ad_template(self):
         self.ensure_one()
@@ -39,11 +55,44 @@ class AzureADCalendar(models.Model):
 
     
     def get_events(self, delta_token=None):
-        azure_events, delta_token_new = self.get_events_from_azure(delta_token)
+        return [event for events in self.get_event_pages(delta_token) for event in events]
+
+    def get_event_pages(self, delta_token=None):
+        """Yields the events of every page of the calendar view delta as it arrives.
+
+        Once the caller asks for the next page, the previous one is considered processed and its checkpoint stored.
+        In the pull crons, which set office365_commit_checkpoints, the checkpoint is committed with the changes of the
+        page, so a killed or timed out worker resumes from it."""
+        commit = self.env.context.get('office365_commit_checkpoints') and not (self.env.registry.in_test_mode() or getattr(threading.current_thread(), 'testing', False))
+
+        for page in self.get_pages_from_azure(delta_token):
+            yield self.get_events_from_page(page['value'])
+
+            if u'@odata.nextLink' in page:
+                self.sync_link = page[u'@odata.nextLink']
+
+                if commit:
+                    self.env.cr.commit()
+            else:
+                self.write({
+                    'sync_link': False,
+                    'delta_token': AzureADCalendar.extract_delta_token(page[u'@odata.deltaLink']),
+                })
+
+    def get_events_from_page(self, azure_events):
         ignore_without_category = self.azure_ad_user_id.calendar_ignore_without_category
 
         # Dictionary of SeriesMasters, speeds up lookups
         series_masters = {e['Id']: e for e in azure_events if 'Type' in e and e['Type'] == 'SeriesMaster'}
+        self.cache_series_masters(series_masters.values())
+
+        # SeriesMasters of occurrences not in this page are fetched at once, with the most recent change of their occurrences
+        missing_masters = {}
+        for event in azure_events:
+            if event.get('Type') == 'Occurrence' and event['SeriesMasterId'] not in series_masters:
+                missing_masters[event['SeriesMasterId']] = max(missing_masters.get(event['SeriesMasterId'], ''), event.get('LastModifiedDateTime') or '')
+
+        series_masters.update(self.get_series_masters(missing_masters))
 
         events = []
 
@@ -61,12 +110,7 @@ class AzureADCalendar(models.Model):
             if event['Type'] == 'Occurrence':
                 series_master_id = event['SeriesMasterId']
 
-                # Check if it exists in the current masters list
-                if series_master_id in series_masters:
-                    master = series_masters[series_master_id]
-                # Does not exists, get from server
-                else:
-                    master = self.azure_ad_user_id.get_data(domain=EVENTS_DATA_DOMAIN, data_id=series_master_id)
+                master = series_masters[series_master_id]
             else:
                 master = event
 
@@ -99,19 +143,64 @@ class AzureADCalendar(models.Model):
                 last_modified=datetime.strptime(master['LastModifiedDateTime'][:19], DATETIME_FORMAT)
             ))
 
-        self.delta_token = delta_token_new
-
         return events
 
+    def get_series_masters(self, last_modified_by_id):
+        """Returns the SeriesMasters by id, from the cache when not older than the given LastModifiedDateTime, others
+        are fetched in one batch request"""
+        user = self.azure_ad_user_id
+        masters = {}
+        to_fetch = []
+
+        for master_id, last_modified in last_modified_by_id.items():
+            cached = _series_master_cache.get((self.env.cr.dbname, user.id, master_id))
+
+            if cached and (cached.get('LastModifiedDateTime') or '') >= last_modified:
+                masters[master_id] = cached
+            else:
+                to_fetch.append(master_id)
+
+        if to_fetch:
+            batch_requests = [user.prepare_batch_request(method='GET', domain=EVENTS_DATA_DOMAIN, data_id=master_id, select=self.get_event_select_fields()) for master_id in to_fetch]
+            fetched = [user.process_response(response) for response in user.batch_request(batch_requests=batch_requests)]
+
+            self.cache_series_masters(fetched)
+            masters.update(zip(to_fetch, fetched))
+
+        return masters
+
+    def cache_series_masters(self, masters):
+        for master in masters:
+            key = (self.env.cr.dbname, self.azure_ad_user_id.id, master['Id'])
+            cached = _series_master_cache.get(key)
+
+            if not cached or (cached.get('LastModifiedDateTime') or '') <= (master.get('LastModifiedDateTime') or ''):
+                _series_master_cache.set(key, master)
+
     
-    def get_events_from_azure(self, delta_token):
+    def get_pages_from_azure(self, delta_token):
         start = datetime.utcnow() - timedelta(days=30)
         end = start + timedelta(days=530)
 
         params = '?startDateTime=%sZ&endDateTime=%sZ' % (start.strftime(DATETIME_FORMAT), end.strftime(DATETIME_FORMAT)) + ('&$deltaToken=%s' % delta_token if delta_token else '')
+        domain = self.azure_ad_user_id.add_select((CALENDAR_CALENDAR_VIEW_DOMAIN + params) % self.uid, self.get_event_select_fields())
 
         try:
-            data = self.azure_ad_user_id.sync_request(domain=(CALENDAR_CALENDAR_VIEW_DOMAIN + params) % self.uid)
+            # Resume an interrupted pull from its last checkpoint
+            if self.sync_link:
+                try:
+                    yield from self.azure_ad_user_id.sync_pages(url=self.sync_link)
+
+                    return
+                except NotFoundError as e:
+                    if e.status_code != 410:
+                        raise e
+
+                    _logger.info('Sync checkpoint of calendar %s expired, restarting pull' % self.id)
+
+                    self.sync_link = False
+
+            yield from self.azure_ad_user_id.sync_pages(domain=domain)
         except Exception as e:
             exception_type = e.__class__.__name__
 
@@ -127,27 +216,46 @@ class AzureADCalendar(models.Model):
 
             raise e
 
-        return data['value'], AzureADCalendar.extract_delta_token(data['@odata.deltaLink'])
-
     
     def get_changes(self):
         return self.get_events(self.delta_token)
 
+    def get_change_pages(self):
+        return self.get_event_pages(self.delta_token)
+
     def sync(self):
         self.ensure_one()
+        count = 0
+
+        # Attendee partners resolved during this run, by lowercase email
+        partner_cache = {}
+
+        # Process changed events page per page, a failing page is rolled back and retried from its checkpoint
+        for changes in self.get_change_pages():
+            with self.env.cr.savepoint():
+                count += self.sync_events(changes, partner_cache=partner_cache)
+
+        return count
+
+    def sync_events(self, changes, partner_cache=None):
+        self.ensure_one()
+        partner_cache = {} if partner_cache is None else partner_cache
         updated_count = 0
         created_count = 0
         deleted_count = 0
 
-        # Get changed events
-        changes = self.get_changes()
         ignore_without_category = self.azure_ad_user_id.calendar_ignore_without_category
+        azure_ad_record_link_obj = self.env['azure.ad.user.record.link'].sudo()
 
-        for ad_event in changes:
-            azure_ad_record_link_obj = self.env['azure.ad.user.record.link'].sudo()
+        # Links and candidate events of the whole page, the loop below works from these maps
+        links_by_uid, events_by_key = self.prefetch_page(changes)
+
+        # Attendee partners of the whole page at once
+        self.prefetch_page_attendees(changes, links_by_uid, events_by_key, partner_cache)
 
+        for ad_event in changes:
             # Check if already linked
-            link = azure_ad_record_link_obj.search([('data_id', '=', ad_event.uid)])
+            link = links_by_uid.get(ad_event.uid, azure_ad_record_link_obj)
             if link and link.record:
                 # Already in Odoo, patch
                 if ad_event.is_deleted:
@@ -176,16 +284,23 @@ class AzureADCalendar(models.Model):
                     if link.record.from_outlook and ad_event.ical_uid != link.record.outlook_ical_uid:
                         link.record.write({'outlook_ical_uid': ad_event.ical_uid})
 
+                    sync_hash = ad_event.get_sync_hash(with_attendees=link.record.from_outlook)
+
                     # Only patch if syncing from azure 2 odoo
                     if link.sync_type in ['none', 'o2a']:
                         pass
+                    # Echo of our own push, or unchanged since it was last applied
+                    elif sync_hash == link.get_in_sync_hash():
+                        pass
                     else:
-                        odoo_fields = ad_event.get_odoo_fields(self.env)
+                        field_names = ['name', 'description', 'start', 'stop', 'allday', 'location', 'outlook_categories']
+                        attendee_hash = ad_event.get_attendee_hash()
 
-                        # Don't update attendees if it wasn't originally created in Odoo
-                        if not link.record.from_outlook:
-                            del odoo_fields['partner_ids']
+                        # Only update attendees of events created from Outlook, and only when they changed since last applied
+                        if link.record.from_outlook and attendee_hash != link.attendee_hash:
+                            field_names.append('partner_ids')
 
+                        odoo_fields = ad_event.get_odoo_fields(self.env, field_names=field_names, partner_cache=partner_cache)
                         patch_fields = link.record.extract_changed(odoo_fields)
 
                         # Patch
@@ -196,20 +311,31 @@ class AzureADCalendar(models.Model):
 
                             updated_count += 1
 
+                        link_vals = {'applied_hash': sync_hash, 'sent_hash': False}
+
+                        if 'partner_ids' in field_names:
+                            link_vals['attendee_hash'] = attendee_hash
+
+                        link.write(link_vals)
+
             # New event for current user
             else:
                 if ad_event.is_deleted or (ad_event.category_removed and ignore_without_category):
                     continue
 
                 # Check if event already imported from other user (iCalUId and time will match)
-                calendar_event_id = self.env['calendar.event'].search([('outlook_ical_uid', '=', ad_event.ical_uid), ('start', '=', fields.Datetime.to_string(ad_event.start_date)), ('stop', '=', fields.Datetime.to_string(ad_event.end_date))]) if ad_event.ical_uid else False
+                event_key = (ad_event.ical_uid, fields.Datetime.to_string(ad_event.start_date), fields.Datetime.to_string(ad_event.end_date))
+                calendar_event_id = events_by_key.get(event_key) if ad_event.ical_uid else False
+
+                if not calendar_event_id and ad_event.ical_uid and is_concurrent_pull(self.env):
+                    self.check_concurrent_event(event_key)
 
                 if calendar_event_id:
                     # All found ids will point to same record, extract it, create link with current event
                     event_id = calendar_event_id
                 else:
                     # Find matching partners based on email address, create those who do not exist
-                    partner_ids = self.env['res.partner'].get_partners_with_email(ad_event.attendees)
+                    partner_ids = self.env['res.partner'].get_partners_with_email(ad_event.attendees, cache=partner_cache)
 
                     # Create odoo calendar event based on parameters provided by outlook calendar event
                     event_id = self.env['calendar.event'].create({
@@ -228,20 +354,91 @@ class AzureADCalendar(models.Model):
                         'outlook_categories': json.dumps(ad_event.categories)
                     })
 
+                    if ad_event.ical_uid:
+                        events_by_key[event_key] = event_id
+
                 # Create record link
-                azure_ad_record_link_obj.create({
+                links_by_uid[ad_event.uid] = azure_ad_record_link_obj.create({
                     'user_id': ad_event.user.id,
                     'data_domain': EVENTS_DATA_DOMAIN,
                     'data_id': ad_event.uid,
                     'create_domain': EVENTS_CREATE_DOMAIN % self.uid,
                     'record': 'calendar.event,%s' % event_id.id,
-                    'sync_type': 'both' if ad_event.owner_email.lower() == ad_event.user.email.lower() else 'a2o'
+                    'sync_type': 'both' if ad_event.owner_email.lower() == ad_event.user.email.lower() else 'a2o',
+                    'applied_hash': ad_event.get_sync_hash(with_attendees=event_id.from_outlook),
+                    'attendee_hash': ad_event.get_attendee_hash() if event_id.from_outlook else False,
                 })
 
                 created_count += 1
 
         return updated_count + created_count + deleted_count
 
+    def check_concurrent_event(self, event_key):
+        """Waits for the pulls of other users creating the same meeting, (iCalUID, start, stop) in event_key.
+
+        Raises ConcurrentCreationError when one of them committed it after the current transaction started, the pull is
+        then rolled back and links the committed event on its next run"""
+        lock_creation(self.env, ['calendar.event,%s,%s,%s' % event_key])
+
+        if fetch_committed(self.env, 'SELECT id FROM calendar_event WHERE outlook_ical_uid = %s AND start = %s AND stop = %s AND active', event_key):
+            raise ConcurrentCreationError('Event %s was created by the pull of another user' % event_key[0])
+
+    def prefetch_page_attendees(self, changes, links_by_uid, events_by_key, partner_cache):
+        """Resolves the attendees of a page of changes into partner_cache.
+
+        Missing partners of the events that will be created are created with one create, those of updated events are
+        only looked up, and created later only when the event turns out to need them"""
+        ignore_without_category = self.azure_ad_user_id.calendar_ignore_without_category
+        new_attendees = {}
+        updated_attendees = {}
+
+        for ad_event in changes:
+            if ad_event.is_deleted or not ad_event.attendees:
+                continue
+
+            linked = links_by_uid.get(ad_event.uid)
+
+            if linked and linked.record:
+                # Attendees unchanged since last applied are not resolved again
+                if linked.attendee_hash != ad_event.get_attendee_hash():
+                    updated_attendees.update(ad_event.attendees)
+            elif not (ad_event.category_removed and ignore_without_category):
+                event_key = (ad_event.ical_uid, fields.Datetime.to_string(ad_event.start_date), fields.Datetime.to_string(ad_event.end_date))
+
+                # Events imported from another user already have their attendees
+                if not (ad_event.ical_uid and event_key in events_by_key):
+                    new_attendees.update(ad_event.attendees)
+
+        partner_obj = self.env['res.partner']
+        partner_obj.resolve_partners_by_email(new_attendees, cache=partner_cache)
+        partner_obj.resolve_partners_by_email(updated_attendees, cache=partner_cache, create_missing=False)
+
+    def prefetch_page(self, changes):
+        """Loads the links and the candidate events of a page of changes in one query each.
+
+        Returns the links of the current user by Outlook id, and the calendar events by (iCalUID, start, stop)"""
+        self.ensure_one()
+
+        uids = list({ad_event.uid for ad_event in changes if ad_event.uid})
+        ical_uids = list({ad_event.ical_uid for ad_event in changes if ad_event.ical_uid and not ad_event.is_deleted})
+
+        links_by_uid = {}
+        events_by_key = {}
+
+        if uids:
+            links = self.env['azure.ad.user.record.link'].sudo().search([('user_id', '=', self.azure_ad_user_id.id), ('data_id', 'in', uids)])
+
+            for link in links:
+                links_by_uid.setdefault(link.data_id, link)
+
+        if ical_uids:
+            events = self.env['calendar.event'].search([('outlook_ical_uid', 'in', ical_uids)])
+
+            for event in events:
+                events_by_key.setdefault((event.outlook_ical_uid, fields.Datetime.to_string(event.start), fields.Datetime.to_string(event.stop)), event)
+
+        return links_by_uid, events_by_key
+
     def create_outlook_event(self, odoo_event, ad_event, link_attendees=True):
         self.ensure_one()
         ad_event.attendees_in_body = not link_attendees
@@ -269,7 +466,7 @@ class AzureADCalendar(models.Model):
         domain = CALENDAR_DATA_DOMAIN % self.uid
 
         try:
-            self.azure_ad_user_id.get_data(domain=domain)
+            self.azure_ad_user_id.get_data(domain=domain, select=['Id'])
         except Exception:
             traceback.print_exc()
 
@@ -283,7 +480,7 @@ class AzureADCalendar(models.Model):
     
     def unlink(self):
         for calendar in self:
-            links = self.env['azure.ad.user.record.link'].sudo().search([('create_domain', 'like', calendar.uid)])
+            links = self.env['azure.ad.user.record.link'].sudo().search([('parent_data_id', '=', calendar.uid)])
 
             # Remove record if this user was the creator, otherwise unlink
             for link in links:
@@ -312,10 +509,15 @@ class AzureADCalendar(models.Model):
     # -------
     #  MODEL
     # -------
+    @api.model
+    def get_event_select_fields(self):
+        """Returns the event properties to request from Outlook, extend when reading more properties"""
+        return EVENT_SELECT_FIELDS
+
     @api.model
     def get_all_calendars(self, user):
         calendar_groups = self.get_calender_groups(user)
-        batch_requests = [user.prepare_batch_request(method="GET", domain=CALENDARGROUPS_DATA_DOMAIN % cg.uid) for cg in calendar_groups]
+        batch_requests = [user.prepare_batch_request(method="GET", domain=CALENDARGROUPS_DATA_DOMAIN % cg.uid, select=CALENDAR_SELECT_FIELDS) for cg in calendar_groups]
 
         calendars = []
 
@@ -327,7 +529,7 @@ class AzureADCalendar(models.Model):
 
     @api.model
     def get_calender_groups(self, user):
-        data = user.get_data(CALENDARGROUPS_TOP_DOMAIN)
+        data = user.get_data(CALENDARGROUPS_TOP_DOMAIN, select=CALENDAR_SELECT_FIELDS)
 
         groups = []
 
@@ -1,4 +1,5 @@
 # See LICENSE file for full copyright and licensing details.
+import hashlib
 import json
 import re
 from datetime import timedelta
@@ -54,18 +55,52 @@ class AzureADEvent:
                    + '\n\n' \
                    + _('Synced from a calendar event in Odoo')
 
-    def get_odoo_fields(self, env):
-        return {
-            'name': self.subject,
-            'description': self.body,
-            'start': self.start_date.strftime(DEFAULT_SERVER_DATETIME_FORMAT),
-            'stop': self.end_date.strftime(DEFAULT_SERVER_DATETIME_FORMAT),
-            'allday': self.all_day,
-            'location': self.location,
-            'outlook_categories': json.dumps(self.categories),
-            'partner_ids': [(6, 0, list(set(env['res.partner'].get_partners_with_email(self.attendees).ids)))]
+    @staticmethod
+    def compute_sync_hash(subject, body, start, stop, all_day, location, attendee_emails, categories):
+        """Returns the hash of the canonical content of an event, computed the same way for Odoo and Outlook events.
+
+        Attendees are left out when attendee_emails is None, whitespace differences in the body are ignored."""
+        content = [
+            (subject or '').strip(),
+            re.sub(r'\s+', ' ', body or '').strip(),
+            start,
+            stop,
+            bool(all_day),
+            (location or '').strip(),
+            sorted({email.lower() for email in attendee_emails if email}) if attendee_emails is not None else None,
+            sorted(categories or []),
+        ]
+
+        return hashlib.sha1(json.dumps(content).encode()).hexdigest()
+
+    def get_sync_hash(self, with_attendees=True):
+        return self.compute_sync_hash(
+            self.subject, self.body,
+            self.start_date.strftime(DEFAULT_SERVER_DATETIME_FORMAT), self.end_date.strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+            self.all_day, self.location, list(self.attendees or {}) if with_attendees else None, self.categories,
+        )
+
+    def get_attendee_hash(self):
+        """Returns the hash of the attendee email set, compared with the hash on the link to skip resolving unchanged attendees"""
+        return hashlib.sha1(json.dumps(sorted({email.lower() for email in self.attendees or {} if email})).encode()).hexdigest()
+
+    def get_odoo_fields(self, env, field_names=None, partner_cache=None):
+        """Returns the Odoo values of the event, only for field_names when given.
+
+        Attendees are only resolved to partners, and missing partners created, when partner_ids is requested"""
+        getters = {
+            'name': lambda: self.subject,
+            'description': lambda: self.body,
+            'start': lambda: self.start_date.strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+            'stop': lambda: self.end_date.strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+            'allday': lambda: self.all_day,
+            'location': lambda: self.location,
+            'outlook_categories': lambda: json.dumps(self.categories),
+            'partner_ids': lambda: [(6, 0, list(set(env['res.partner'].get_partners_with_email(self.attendees, cache=partner_cache).ids)))],
         }
 
+        return {name: getter() for name, getter in getters.items() if field_names is None or name in field_names}
+
     def get_azure_template(self):
         return {
             'Subject': self.subject or '',
@@ -17,7 +17,7 @@ class AzureAdPullQueueItem(models.Model):
         self.ensure_one()
         if self.domain == 'calendar' or not self.domain:
             try:
-                updated += sum(self.user_id.calendar_id.sync())
+                updated += self.user_id.calendar_id.sync()
             except Exception:
                 # Exception normally catched higher
 
@@ -1,22 +1,81 @@
 # See LICENSE file for full copyright and licensing details.
-from odoo import api, models
+from odoo import api, models, tools
+
+from odoo.addons.office365_framework.models.concurrency import is_concurrent_pull, lock_creation, fetch_committed
+from odoo.addons.office365_framework.models.exceptions import ConcurrentCreationError
+
+# Partners with the email, or whose Azure AD user has it
+PARTNERS_BY_EMAIL_QUERY = """
+    SELECT lower(p.email), p.id
+      FROM res_partner p
+     WHERE lower(p.email) IN %s AND p.active
+     UNION
+    SELECT lower(u.email), p.id
+      FROM azure_ad_user u
+      JOIN res_partner p ON p.id = u.partner_id
+     WHERE lower(u.email) IN %s AND p.active
+"""
 
 
 class ResPartner(models.Model):
     _inherit = 'res.partner'
 
-    @api.model
-    def get_partners_with_email(self, emails):
-        partner_ids = self.browse()
+    def init(self):
+        # Attendees are matched case insensitively on their email
+        tools.create_index(self._cr, 'res_partner_lower_email_index', self._table, ['lower(email)'])
 
+    @api.model
+    def get_partners_with_email(self, emails, cache=None):
+        """Returns the partners of the attendee emails, creates those who do not exist"""
         emails = emails or {}
+        cache = self.resolve_partners_by_email(emails, cache=cache)
 
-        for email, name in emails.items():
-            partner_id = self.search(['|', ('email', '=ilike', email), ('azure_ad_user_id.email', '=ilike', email)])
+        partner_ids = self.browse()
 
-            if partner_id:
-                partner_ids += partner_id
-            else:
-                partner_ids += self.create({'name': name, 'email': email})
+        for email in emails:
+            if email:
+                partner_ids |= cache[email.lower()]
 
         return partner_ids
+
+    @api.model
+    def resolve_partners_by_email(self, emails, cache=None, create_missing=True):
+        """Resolves {email: name} attendees to partners with one query, missing partners are created at once.
+
+        Returns the cache, a dict of lowercase email to partners, pass it again to skip emails resolved before"""
+        cache = {} if cache is None else cache
+        names = {}
+
+        for email, name in (emails or {}).items():
+            if email and email.lower() not in cache:
+                names.setdefault(email.lower(), (email, name))
+
+        if not names:
+            return cache
+
+        self.env.cr.execute(PARTNERS_BY_EMAIL_QUERY, (tuple(names), tuple(names)))
+
+        found = {}
+
+        for email, partner_id in self.env.cr.fetchall():
+            found.setdefault(email, []).append(partner_id)
+
+        for email, partner_ids in found.items():
+            cache[email] = self.browse(partner_ids)
+
+        missing = [key for key in names if key not in found]
+
+        if missing and create_missing:
+            # Pulls of other users may create the same attendees, wait for them and check what they committed
+            if is_concurrent_pull(self.env):
+                lock_creation(self.env, ['res.partner,%s' % key for key in missing])
+
+                if fetch_committed(self.env, PARTNERS_BY_EMAIL_QUERY, (tuple(missing), tuple(missing))):
+                    raise ConcurrentCreationError('Attendees %s were created by the pull of another user' % ', '.join(missing))
+
+            partners = self.create([{'name': names[key][1], 'email': names[key][0]} for key in missing])
+
+            for key, partner in zip(missing, partners):
+                cache[key] = partner
+
+        return cache
@@ -1,11 +1,12 @@
 # See LICENSE file for full copyright and licensing details.
-from odoo import api, models
+from odoo import api, fields, models
 
 
 class AzureAdUserRecordLink(models.Model):
     _inherit = 'azure.ad.user.record.link'
 
-    
+    attendee_hash = fields.Char(string='Attendee Hash', help='Hash of the attendee emails last applied from Outlook, unchanged attendees are not resolved again')
+
     def write(self, vals):
         # Check if ical_uid update is necessary
         if 'ical_uid' in vals and self.record.from_outlook:
@@ -25,7 +25,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 {
     'name': 'Office 365 OAuth Client',
-    'version': '12.0.1.0',
+    'version': '12.0.1.3',
     'author': 'Somko',
     'category': 'Productivity',
     'description': """Handles the connection to Microsoft Office 365 API. This module does not provide any functional use on its own, but should be used in combination with other modules.""",
@@ -0,0 +1,24 @@
+# See LICENSE file for full copyright and licensing details.
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """Fills the parent resource columns from the second segment of domains like calendars/<id>/events"""
+    if not version:
+        return
+
+    cr.execute("""
+        UPDATE azure_ad_push_queue_item
+           SET parent_data_id = CASE WHEN split_part(data_domain, '/', 2) = '%s' THEN data_id ELSE split_part(data_domain, '/', 2) END
+         WHERE parent_data_id IS NULL AND data_domain LIKE '%/%/%'
+    """)
+    _logger.info('AzureAD Parent id set on %s push queue items' % cr.rowcount)
+
+    cr.execute("""
+        UPDATE azure_ad_user_record_link
+           SET parent_data_id = CASE WHEN split_part(create_domain, '/', 2) = '%s' THEN data_id ELSE split_part(create_domain, '/', 2) END
+         WHERE parent_data_id IS NULL AND create_domain LIKE '%/%/%'
+    """)
+    _logger.info('AzureAD Parent id set on %s record links' % cr.rowcount)
@@ -0,0 +1,48 @@
+# See LICENSE file for full copyright and licensing details.
+import json
+import logging
+
+from odoo.addons.office365_framework.models.azure_ad_change_baseline import serialize_value
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """Moves the change_original_values JSON of every synced model into azure_ad_change_baseline and drops the column"""
+    if not version:
+        return
+
+    cr.execute("SELECT table_name FROM information_schema.columns WHERE column_name = 'change_original_values' AND table_schema = current_schema()")
+    tables = [row[0] for row in cr.fetchall()]
+
+    cr.execute('SELECT model FROM ir_model')
+    models_by_table = {model.replace('.', '_'): model for model, in cr.fetchall()}
+
+    for table in tables:
+        model = models_by_table.get(table)
+
+        if model:
+            cr.execute("SELECT id, change_original_values FROM \"%s\" WHERE change_original_values IS NOT NULL AND change_original_values != ''" % table)
+
+            rows = []
+
+            for res_id, original_values in cr.fetchall():
+                try:
+                    values = json.loads(original_values)
+                except ValueError:
+                    continue
+
+                for field_name, value in values.items():
+                    rows.append((res_id, field_name) + serialize_value(value))
+
+            if rows:
+                cr.execute("""
+                    INSERT INTO azure_ad_change_baseline (res_model, res_id, field_name, value, value_type, value_hash, create_date, write_date)
+                    SELECT %s, v.res_id, v.field_name, v.value, v.value_type, v.value_hash, now() at time zone 'UTC', now() at time zone 'UTC'
+                      FROM unnest(%s::int[], %s::text[], %s::text[], %s::text[], %s::text[]) AS v(res_id, field_name, value, value_type, value_hash)
+                    ON CONFLICT (res_model, res_id, field_name) DO NOTHING
+                """, [model] + [list(column) for column in zip(*rows)])
+
+            _logger.info('AzureAD Moved %s previously synced values of %s to azure_ad_change_baseline' % (len(rows), model))
+
+        cr.execute('ALTER TABLE "%s" DROP COLUMN change_original_values' % table)
@@ -0,0 +1,19 @@
+# See LICENSE file for full copyright and licensing details.
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """Fills the record model and real id columns from references like calendar.event,12-20200101100000"""
+    if not version:
+        return
+
+    for table in ['azure_ad_user_record_link', 'azure_ad_change_queue_item']:
+        cr.execute("""
+            UPDATE %s
+               SET res_model = split_part(record, ',', 1),
+                   res_id = split_part(split_part(record, ',', 2), '-', 1)::integer
+             WHERE res_model IS NULL AND split_part(record, ',', 2) ~ '^[0-9]+(-[0-9]+)?$'
+        """ % table)
+        _logger.info('AzureAD Record model and id set on %s rows of %s' % (cr.rowcount, table))
@@ -1,6 +1,11 @@
 # See LICENSE file for full copyright and licensing details.
 from . import fields
 from . import exceptions
+from . import transport
+from . import cache
+from . import concurrency
+from . import throttle
+from . import azure_ad_change_baseline
 from . import abstracts
 from . import queues
 from . import user
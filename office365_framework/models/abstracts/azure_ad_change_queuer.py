@@ -1,10 +1,12 @@
 # See LICENSE file for full copyright and licensing details.
 import json
 import logging
-from datetime import datetime
+from datetime import date, datetime
 
 from odoo import models, fields, api
 
+from ..azure_ad_change_baseline import hash_value
+
 _logger = logging.getLogger(__name__)
 
 
@@ -12,7 +14,6 @@ class AzureADChangeQueuer(models.AbstractModel):
     _name = 'azure.ad.change.queuer'
 
     change_last_write = fields.Datetime(string="Change Queue Last Write")
-    change_original_values = fields.Char(string="JSON Object which holds the previously synced values")
 
     def write(self, vals):
         is_o_value_update = self.env.context.get('is_o_value_update')
@@ -22,29 +23,7 @@ class AzureADChangeQueuer(models.AbstractModel):
         # -- Actions to perform before Write --
         # Logic if regular write, should save changed fields since last change push
         if not (is_o_value_update or is_external_change or is_change_push):
-            for record in self:
-                changed_values = {}
-                original_values = json.loads(record.change_original_values or '{}')
-                observed_keys = self.get_change_observed_values()
-
-                for k, v in vals.items():
-                    if k in observed_keys and k not in original_values:
-                        if hasattr(record[k], 'ids') and type(v) == list and len(v) and len(v[0]) == 3:
-                            ids = v[0][2]
-                            if record[k].ids != ids:
-                                changed_values[k] = [(6, 0, record[k].ids)]
-                        elif hasattr(record[k], 'id'):
-                            if record[k].id != v:
-                                changed_values[k] = record[k].id
-                        elif type(record[k]) == datetime:
-                            changed_values[k] = fields.Datetime.to_string(record[k])
-                        else:
-                            changed_values[k] = record[k]
-
-                if changed_values:
-                    original_values.update(changed_values)
-
-                    record.with_context(is_o_value_update=True).write({'change_original_values': json.dumps(original_values)})
+            self.store_original_values(vals)
 
         # -- Write --
         # Don't save if change is coming from an external system
@@ -60,14 +39,30 @@ class AzureADChangeQueuer(models.AbstractModel):
                 _logger.info('AzureAD Links patched for record %s,%s' % (self.ids, self._name))
 
                 for record in self:
-                    record.get_links().patch(record.get_azure_ad_template(vals))
+                    links = record.get_links()
+                    sync_hash = record.get_sync_hash()
+
+                    # Content Outlook already has, sent by us or just pulled from it, is not pushed again
+                    if sync_hash and set(vals) <= set(record.get_sync_hash_fields()):
+                        links = links.filtered(lambda link: sync_hash != link.get_in_sync_hash())
+
+                    links.patch(record.get_azure_ad_template(vals))
+
+                    link_vals = record.get_pushed_link_values(vals)
+
+                    if sync_hash:
+                        link_vals.update({'sent_hash': sync_hash, 'applied_hash': False})
+
+                    if link_vals:
+                        links.write(link_vals)
 
                     # Parent changed, update children
                     if hasattr(record, 'child_ids') and record.child_ids:
                         for child in record.child_ids:
-                            self.env['azure.ad.user.record.link'].sudo().search([('record', '=', '%s,%s' % (self._name, child.id))]).patch(record.get_azure_ad_template(vals, is_child=True))
+                            self.env['azure.ad.user.record.link'].sudo().search(self.env['azure.ad.user.record.link'].get_reference_domain(child)).patch(record.get_azure_ad_template(vals, is_child=True))
 
-                    record.with_context(is_o_value_update=True).write({'change_original_values': ''})
+                # Pushed, the current values are the synced values again
+                self.env['azure.ad.change.baseline'].sudo().clear(self._name, list({self.get_real_id(record_id) for record_id in self.ids}))
 
             # Make change items
             else:
@@ -84,9 +79,48 @@ class AzureADChangeQueuer(models.AbstractModel):
 
             return self
 
+    def store_original_values(self, vals):
+        """Saves the current values of the observed fields changed by vals, unless saved since the last change push.
+
+        Reads the fields of all records at once and stores the baselines in one statement."""
+        observed_keys = self.get_change_observed_values()
+        keys = [k for k in vals if k in observed_keys and k in self._fields]
+
+        if not keys or not self:
+            return
+
+        baselines = []
+
+        for row in self.read(keys, load=None):
+            # Virtual records, like recurring events, store their values on the real record
+            real_id = self.get_real_id(row['id'])
+
+            for k in keys:
+                value = row[k]
+                v = vals[k]
+
+                if self._fields[k].type in ['one2many', 'many2many']:
+                    if type(v) == list and len(v) and len(v[0]) == 3 and value != v[0][2]:
+                        baselines.append((real_id, k, [(6, 0, value)]))
+                elif self._fields[k].type == 'many2one':
+                    if value != v:
+                        baselines.append((real_id, k, value))
+                elif isinstance(value, datetime):
+                    baselines.append((real_id, k, fields.Datetime.to_string(value)))
+                elif isinstance(value, date):
+                    baselines.append((real_id, k, fields.Date.to_string(value)))
+                else:
+                    baselines.append((real_id, k, value))
+
+        # Fields with a baseline since the last change push keep it
+        self.env['azure.ad.change.baseline'].sudo().store(self._name, baselines)
+
     def unlink(self):
         self.remove_links()
 
+        # Occurrences of virtual records share the baseline of their real record
+        self.env['azure.ad.change.baseline'].sudo().clear(self._name, [record_id for record_id in self.ids if isinstance(record_id, int)])
+
         return super(AzureADChangeQueuer, self).unlink()
 
     def remove_links(self):
@@ -100,7 +134,7 @@ class AzureADChangeQueuer(models.AbstractModel):
         self.ensure_one()
 
         patch_fields = {}
-        original_values = json.loads(self.change_original_values or '{}')
+        baseline_hashes = self.env['azure.ad.change.baseline'].sudo().get_hashes(self._name, self.get_real_id(self.id), [name for name in data if name in self])
 
         for name, value in data.items():
             # Code should continue to next for iteration if
@@ -111,13 +145,13 @@ class AzureADChangeQueuer(models.AbstractModel):
             #  - Regular field value same as current value
 
             if name in self:
-                if name in original_values:
-                    # Saved in original_values, compare with original_values
+                if name in baseline_hashes:
+                    # Saved in the baseline, compare with the baseline
 
-                    if original_values[name] == value:
+                    if baseline_hashes[name] == hash_value(value):
                         continue
                 else:
-                    # Not saved in original_values, compare with self
+                    # Not saved in the baseline, compare with self
                     if hasattr(self[name], 'ids'):
                         # Relation type
                         if len(set(self[name].ids) ^ set(value[0][2])) == 0:
@@ -216,6 +250,31 @@ class AzureADChangeQueuer(models.AbstractModel):
     def get_change_observed_values(self):
         return []
 
+    def get_sync_hash(self):
+        """Returns a hash of the synced content of the record, compared with the hashes on its links to skip echoed changes.
+
+        False disables echo suppression for the model."""
+        return False
+
+    def get_sync_hash_fields(self):
+        """Returns the fields covered by get_sync_hash, changes of other fields are always pushed"""
+        return []
+
+    def get_pushed_link_values(self, vals):
+        """Returns the values written on the links the change vals was pushed to"""
+        return {}
+
+    @staticmethod
+    def get_real_id(record_id):
+        """Returns the id of the real record of a virtual record id like 12-20200101100000"""
+        return int(str(record_id).split('-')[0])
+
     def get_record_link_domain(self):
-        return [('record', '=', '%s,%s' % (self._name, self.id))]
+        """Domain of the links and change items of the record, a real record also matches its virtual occurrences"""
+        domain = [('res_model', '=', self._name), ('res_id', '=', self.get_real_id(self.id))]
+
+        if not isinstance(self.id, int):
+            domain.append(('record', '=', '%s,%s' % (self._name, self.id)))
+
+        return domain
 
@@ -0,0 +1,75 @@
+# See LICENSE file for full copyright and licensing details.
+import hashlib
+import json
+
+from odoo import models, fields, api
+
+
+def serialize_value(value):
+    """Returns the JSON, type name and hash stored for a synced value"""
+    serialized = json.dumps(value, sort_keys=True)
+
+    return serialized, type(value).__name__, hashlib.sha1(serialized.encode()).hexdigest()
+
+
+def hash_value(value):
+    return serialize_value(value)[2]
+
+
+class AzureAdChangeBaseline(models.Model):
+    _name = 'azure.ad.change.baseline'
+    _description = 'Azure AD Previously Synced Value'
+
+    res_model = fields.Char(string='Model', required=True)
+    res_id = fields.Integer(string='Record Id', required=True)
+    field_name = fields.Char(string='Field', required=True)
+    value = fields.Text(string='Value, JSON')
+    value_type = fields.Char(string='Value Type')
+    value_hash = fields.Char(string='Value Hash')
+
+    _sql_constraints = [
+        ('record_field_uniq', 'unique(res_model, res_id, field_name)', 'A field can only have one previously synced value per record'),
+    ]
+
+    @api.model
+    def store(self, res_model, baselines):
+        """Stores (res_id, field_name, value) baselines, fields that already have a baseline keep it"""
+        if not baselines:
+            return
+
+        rows = {}
+
+        # First value wins, like the values already stored
+        for res_id, field_name, value in baselines:
+            rows.setdefault((res_id, field_name), serialize_value(value))
+
+        self.env.cr.execute("""
+            INSERT INTO azure_ad_change_baseline (res_model, res_id, field_name, value, value_type, value_hash, create_uid, create_date, write_uid, write_date)
+            SELECT %s, v.res_id, v.field_name, v.value, v.value_type, v.value_hash, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC'
+              FROM unnest(%s::int[], %s::text[], %s::text[], %s::text[], %s::text[]) AS v(res_id, field_name, value, value_type, value_hash)
+            ON CONFLICT (res_model, res_id, field_name) DO NOTHING
+        """, (
+            res_model, self.env.uid, self.env.uid,
+            [k[0] for k in rows], [k[1] for k in rows], [r[0] for r in rows.values()], [r[1] for r in rows.values()], [r[2] for r in rows.values()],
+        ))
+
+    @api.model
+    def get_hashes(self, res_model, res_id, field_names):
+        """Returns the baseline hash of the fields of a record that have one"""
+        if not field_names:
+            return {}
+
+        self.env.cr.execute(
+            'SELECT field_name, value_hash FROM azure_ad_change_baseline WHERE res_model = %s AND res_id = %s AND field_name IN %s',
+            (res_model, res_id, tuple(field_names)),
+        )
+
+        return dict(self.env.cr.fetchall())
+
+    @api.model
+    def clear(self, res_model, res_ids):
+        """Removes the baselines of the records, after their changes have been pushed"""
+        if not res_ids:
+            return
+
+        self.env.cr.execute('DELETE FROM azure_ad_change_baseline WHERE res_model = %s AND res_id IN %s', (res_model, tuple(res_ids)))
@@ -0,0 +1,141 @@
+# See LICENSE file for full copyright and licensing details.
+"""Encoding and decoding of the multipart/mixed bodies of the Outlook $batch endpoint.
+
+Kept free of Odoo imports, so it can be benchmarked on its own."""
+
+BATCH_MAX_REQUESTS = 20
+
+
+def encode_batch_request(method, url, data=None):
+    """Returns the MIME part of one request in a $batch body, without its boundary"""
+    if data:
+        return "Content-Type: application/http\nContent-Transfer-Encoding: binary\n\n%s %s HTTP/1.1\nContent-Type: application/json\n\n%s\n\n" % (method, url, data)
+
+    return "Content-Type: application/http\nContent-Transfer-Encoding: binary\n\n%s %s HTTP/1.1\n\n\n\n" % (method, url)
+
+
+def encode_batch(parts, batch_id):
+    """Returns the $batch body for the encoded request parts, numbered from 1 by their Content-ID"""
+    chunks = []
+
+    for content_id, part in enumerate(parts, 1):
+        chunks.append("--batch_%s\nContent-ID: %s\n" % (batch_id, content_id))
+        chunks.append(part)
+
+    # Newlines required, otherwise microsoft returns JSON parse error
+    chunks.append("--batch_%s--\n\n\n" % batch_id)
+
+    return "".join(chunks)
+
+
+class BatchResponsePart:
+    def __init__(self, content_id, status_code, headers, body):
+        self.content_id = content_id
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+
+class BatchHeaders(dict):
+    """Header dictionary with case insensitive lookups"""
+
+    def __init__(self, items=()):
+        super(BatchHeaders, self).__init__((k.lower(), v) for k, v in items)
+
+    def get(self, key, default=None):
+        return super(BatchHeaders, self).get(key.lower(), default)
+
+    def __getitem__(self, key):
+        return super(BatchHeaders, self).__getitem__(key.lower())
+
+    def __contains__(self, key):
+        return super(BatchHeaders, self).__contains__(key.lower())
+
+
+def _read_headers(text, pos, end):
+    """Reads header lines from pos up to the first empty line, returns the headers and the position after it"""
+    headers = []
+
+    while pos < end:
+        line_end = text.find('\n', pos, end)
+        if line_end == -1:
+            line_end = end
+
+        line = text[pos:line_end].rstrip('\r')
+        pos = line_end + 1
+
+        if not line:
+            break
+
+        name, sep, value = line.partition(':')
+        if sep:
+            headers.append((name.strip(), value.strip()))
+
+    return headers, pos
+
+
+def _parse_part(text, start, end):
+    mime_headers, pos = _read_headers(text, start, end)
+
+    # Skip empty lines before the status line
+    while pos < end and text[pos] in '\r\n':
+        pos += 1
+
+    status_end = text.find('\n', pos, end)
+    if status_end == -1:
+        status_end = end
+
+    status_line = text[pos:status_end].split(' ', 2)
+    http_headers, body_start = _read_headers(text, status_end + 1, end)
+
+    content_id = BatchHeaders(mime_headers).get('Content-ID') or BatchHeaders(http_headers).get('Content-ID')
+
+    return BatchResponsePart(
+        content_id=content_id.strip('<>') if content_id else None,
+        status_code=int(status_line[1]) if len(status_line) > 1 else 0,
+        headers=BatchHeaders(http_headers),
+        body=text[body_start:end].strip('\r\n') if body_start < end else '',
+    )
+
+
+def iter_batch_response(text):
+    """Yields the parts of a $batch response, scanning the body once.
+
+    The boundary is taken from the first line of the body, the parts keep their Content-ID and headers."""
+    first_line_end = text.find('\n')
+    if first_line_end == -1:
+        return
+
+    delimiter = '\n' + text[:first_line_end].rstrip('\r')
+    pos = first_line_end + 1
+
+    while True:
+        end = text.find(delimiter, pos)
+        if end == -1:
+            return
+
+        yield _parse_part(text, pos, end)
+
+        pos = end + len(delimiter)
+
+        # Closing delimiter
+        if text.startswith('--', pos):
+            return
+
+        pos = text.find('\n', pos) + 1
+        if not pos:
+            return
+
+
+def decode_batch(text, count):
+    """Returns the parts of a $batch response in request order, matched on Content-ID when the server echoes it"""
+    parts = list(iter_batch_response(text))
+    by_content_id = {part.content_id: part for part in parts if part.content_id}
+
+    if len(by_content_id) == len(parts):
+        ordered = [by_content_id.get(str(content_id)) for content_id in range(1, count + 1)]
+
+        if all(ordered):
+            return ordered
+
+    return parts[:count]
@@ -0,0 +1,55 @@
+# See LICENSE file for full copyright and licensing details.
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread safe least recently used cache, shared between the requests of one worker process.
+
+    Entries older than ttl seconds (if given) are treated as missing."""
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                stored, value = self._data[key]
+            except KeyError:
+                return default
+
+            if self.ttl and stored + self.ttl < time.time():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+
+        return item[1] if item else default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,156 @@
+# See LICENSE file for full copyright and licensing details.
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import odoo
+from odoo import api, SUPERUSER_ID
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_SYNC_WORKERS = 1
+DEFAULT_PUSH_DEBOUNCE = 5
+DEFAULT_PUSH_DEBOUNCE_MAX_WAIT = 30
+
+
+def get_sync_workers(env):
+    """Returns the amount of users that may be synchronised concurrently, 1 when running tests"""
+    if env.registry.in_test_mode():
+        return 1
+
+    return max(int(env['ir.config_parameter'].sudo().get_param('office365.sync.workers', DEFAULT_SYNC_WORKERS)), 1)
+
+
+def run_for_users(env, user_ids, callback, max_workers):
+    """Calls callback(env, user_id) for every user on a pool of max_workers threads.
+
+    Every call gets its own cursor and environment and is committed on its own, a failing user is rolled back
+    without affecting the others. Returns a dictionary with the result of every successful call."""
+    registry = env.registry
+    uid = env.uid
+    context = dict(env.context)
+    dbname = env.cr.dbname
+
+    def run(user_id):
+        threading.current_thread().dbname = dbname
+
+        with api.Environment.manage(), registry.cursor() as cr:
+            try:
+                return user_id, callback(api.Environment(cr, uid, context), user_id)
+            except Exception:
+                cr.rollback()
+
+                _logger.exception('AzureAD Processing failed for user %s' % user_id)
+
+                return user_id, None
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='office365_sync') as executor:
+        return dict(executor.map(run, user_ids))
+
+
+def is_concurrent_pull(env):
+    """Returns whether the current transaction pulls one user while other users are pulled in other transactions"""
+    return bool(env.context.get('office365_concurrent_pull'))
+
+
+def lock_creation(env, keys):
+    """Waits until no other transaction creates the records identified by keys, then holds them until the current transaction ends"""
+    for key in sorted(set(keys)):
+        env.cr.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (key,))
+
+
+def fetch_committed(env, query, params=None):
+    """Runs a query in a new transaction, which also sees the rows committed by other transactions after the current one started"""
+    with env.registry.cursor() as cr:
+        cr.execute(query, params)
+
+        return cr.fetchall()
+
+
+class Debouncer:
+    """Calls callback(key) in a background thread once a key has not been triggered for delay seconds.
+
+    A key that keeps being triggered is still called max_wait seconds after its first trigger."""
+
+    def __init__(self, callback):
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._timers = {}
+
+    def trigger(self, key, delay, max_wait):
+        now = time.monotonic()
+
+        with self._lock:
+            timer, first_trigger = self._timers.get(key, (None, now))
+
+            if timer:
+                timer.cancel()
+
+            timer = threading.Timer(max(min(delay, first_trigger + max_wait - now), 0), self._fire, args=(key,))
+            timer.daemon = True
+            self._timers[key] = (timer, first_trigger)
+
+            timer.start()
+
+    def _fire(self, key):
+        with self._lock:
+            self._timers.pop(key, None)
+
+        try:
+            self.callback(key)
+        except Exception:
+            _logger.exception('AzureAD Debounced call failed for %s' % (key,))
+
+
+def push_for_user(key):
+    """Pushes the queue of one user in a new transaction, key is a (database name, azure.ad.user id) tuple"""
+    dbname, user_id = key
+    threading.current_thread().dbname = dbname
+
+    with api.Environment.manage(), odoo.registry(dbname).cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        user = env['azure.ad.user'].search([('id', '=', user_id), ('azure_ad_sync_started', '=', True)] + env['azure.ad.user'].get_not_throttled_domain())
+
+        if user:
+            env['azure.ad.push.queue.item'].process(user)
+
+
+_push_debouncer = Debouncer(push_for_user)
+
+
+def schedule_push(env, user_ids):
+    """Pushes the queues of the users shortly after the current transaction commits.
+
+    Writes in quick succession are pushed together once the users have been quiet for office365.push.debounce seconds."""
+    if env.registry.in_test_mode() or getattr(threading.current_thread(), 'testing', False):
+        return
+
+    config = env['ir.config_parameter'].sudo()
+    delay = float(config.get_param('office365.push.debounce', DEFAULT_PUSH_DEBOUNCE))
+    max_wait = float(config.get_param('office365.push.debounce.max.wait', DEFAULT_PUSH_DEBOUNCE_MAX_WAIT))
+
+    if delay <= 0:
+        return
+
+    cr = env.cr
+    dbname = cr.dbname
+    pending_user_ids = getattr(cr, 'office365_push_user_ids', None)
+
+    # One hook per transaction, collecting the users of all items created in it
+    if pending_user_ids is None:
+        pending_user_ids = cr.office365_push_user_ids = set()
+
+        def trigger():
+            del cr.office365_push_user_ids
+
+            for user_id in pending_user_ids:
+                _push_debouncer.trigger((dbname, user_id), delay, max_wait)
+
+        def discard():
+            del cr.office365_push_user_ids
+
+        cr.after('commit', trigger)
+        cr.after('rollback', discard)
+
+    pending_user_ids.update(user_ids)
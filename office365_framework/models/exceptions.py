@@ -32,14 +32,22 @@ class ServerError(Exception):
 
 
 class ThrottleError(Exception):
-    def __init__(self, msg, status_code=None):
+    def __init__(self, msg, status_code=None, retry_after=None):
         self.status_code = status_code
+        self.retry_after = retry_after
     
         _logger.warning('AzureAD User has reached throttle limit: %s' % msg)
 
         super(ThrottleError, self).__init__(msg)
 
 
+class RequestDeferredError(ThrottleError):
+    """Raised before anything was sent, when the request scheduler or a known throttle holds the request back"""
+
+    def __init__(self, msg, retry_after=None):
+        super(RequestDeferredError, self).__init__(msg, 429, retry_after)
+
+
 class AlreadyExistsError(Exception):
     def __init__(self, msg, status_code=None):
         self.status_code = status_code
@@ -74,3 +82,10 @@ class AuthenticationError(Exception):
         _logger.warning('AzureAD User is not correctly logged in: %s' % msg)
 
         super(AuthenticationError, self).__init__(msg)
+
+
+class ConcurrentCreationError(Exception):
+    def __init__(self, msg):
+        _logger.info('AzureAD Record created concurrently by another transaction, retrying later: %s' % msg)
+
+        super(ConcurrentCreationError, self).__init__(msg)
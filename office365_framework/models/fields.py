@@ -33,3 +33,16 @@ class VirtualReference(Reference):
 
     def convert_to_read(self, value, record, use_name_get=True):
         return "%s,%s" % (value._name, value.id) if value else False
+
+
+def split_reference(value):
+    """Returns the model and real record id of a 'model,id' reference, virtual ids like 12-20200101100000 give 12"""
+    if isinstance(value, BaseModel):
+        value = '%s,%s' % (value._name, value.id) if value else False
+
+    if not value:
+        return False, False
+
+    res_model, res_id = value.split(',')
+
+    return res_model, int(str(res_id).split('-')[0])
@@ -1,7 +1,15 @@
 # See LICENSE file for full copyright and licensing details.
 import json
+import logging
+import threading
 
-from odoo import models, fields, api
+from odoo import models, fields, api, tools
+
+from ..fields import split_reference
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_CHANGE_BATCH_SIZE = 500
 
 
 class AzureAdChangeQueueItem(models.Model):
@@ -10,7 +18,9 @@ class AzureAdChangeQueueItem(models.Model):
 
     change = fields.Char(string='Change, JSON Object')
     time = fields.Datetime(string='Change DateTime')
-    record = fields.Reference(string="Reference", selection='_select_objects')
+    record = fields.Reference(string="Reference", selection='_select_objects', index=True)
+    res_model = fields.Char(string="Record Model")
+    res_id = fields.Integer(string="Record Id")
     user_id = fields.Many2one(comodel_name='azure.ad.user', string='User', ondelete='cascade')
 
     status = fields.Selection(selection=[
@@ -30,31 +40,51 @@ class AzureAdChangeQueueItem(models.Model):
     # Overrides
     # ---------
     def create(self, vals):
+        if 'record' in vals:
+            vals['res_model'], vals['res_id'] = split_reference(vals['record'])
+
         return super(AzureAdChangeQueueItem, self).create(vals)
 
+    def init(self):
+        tools.create_index(self._cr, 'azure_ad_change_queue_item_res_model_res_id_index', self._table, ['res_model', 'res_id'])
+
     # ---------------------
     # Process Push for User
     # ---------------------
     def process_change_for_user(self, user_id):
-        # Get records that the user is subscribed to
-        links = self.env['azure.ad.user'].browse(user_id).record_link_ids
+        """Applies the pending changes of the records the user is linked to, returns the amount of records changed"""
+        self.flush()
+
+        # Claim the changes of the linked records at once, instead of searching them link by link
+        self.env.cr.execute("""
+            UPDATE azure_ad_change_queue_item
+               SET status = 'processing'
+             WHERE id IN (
+                SELECT change.id
+                  FROM azure_ad_change_queue_item change
+                  JOIN azure_ad_user_record_link link ON link.res_model = change.res_model AND link.res_id = change.res_id AND link.record = change.record
+                 WHERE link.user_id = %s AND (change.status IS NULL OR change.status != 'processing'))
+         RETURNING id, record
+        """, (user_id,))
 
-        record_changes = {}
+        record_change_ids = {}
 
-        # Get changes for individual records
-        for link in links:
-            if link.record:
-                changes = self.search(['&', ('status', '!=', 'processing'), ('record', '=', '%s,%s' % (link.record._name, link.record.id))])
+        for change_id, reference in self.env.cr.fetchall():
+            record_change_ids.setdefault(reference, []).append(change_id)
 
-                if changes:
-                    record_changes[link.record] = changes
-                    record_changes[link.record].write({'status': 'processing'})
+        claimed = self.browse([change_id for change_ids in record_change_ids.values() for change_id in change_ids])
+        claimed.invalidate_cache(['status'])
 
         # Process those changes
-        for record, changes in record_changes.items():
-            self.process_record_changes(record, changes)
+        for reference, change_ids in record_change_ids.items():
+            record = self.browse_reference(reference)
+
+            if record:
+                self.process_record_changes(record, self.browse(sorted(change_ids)))
+
+        claimed.unlink()
 
-        return len(record_changes)
+        return len(record_change_ids)
 
     # -------------------------
     # Process Change for Record
@@ -79,8 +109,6 @@ class AzureAdChangeQueueItem(models.Model):
                     if not new_last_write or new_last_write < change_time:
                         new_last_write = change_time
 
-            change.unlink()
-
         if field_changes:
             record.with_context(is_change_push=True).write({k: v[0] for k, v in field_changes.items()})
 
@@ -88,15 +116,88 @@ class AzureAdChangeQueueItem(models.Model):
     # Triggered Methods
     # -----------------
     @api.model
-    def process_queue(self):
-        queue_items = self.search([('status', '!=', 'processing')])
-        queue_items.write({'status': 'processing'})
+    def process_queue(self, batch_size=None):
+        """Applies all pending changes in chunks of at most batch_size records, committing after every chunk"""
+        batch_size = batch_size or self.get_change_batch_size()
+        commit = not (self.env.registry.in_test_mode() or getattr(threading.current_thread(), 'testing', False))
+
+        last_id = 0
+        processed = 0
+
+        while True:
+            self.flush()
+
+            # Next records with pending changes, all their changes are applied in the same chunk
+            self.env.cr.execute("""
+                SELECT id, record
+                  FROM azure_ad_change_queue_item
+                 WHERE id > %s AND record IS NOT NULL AND (status IS NULL OR status != 'processing')
+              ORDER BY id
+                 LIMIT %s
+            """, (last_id, batch_size))
+            rows = self.env.cr.fetchall()
+
+            if not rows:
+                break
+
+            last_id = rows[-1][0]
+            processed += self.process_chunk(list({reference for change_id, reference in rows}))
+
+            if commit:
+                self.env.cr.commit()
 
-        record_changes = {}
+        return processed
+
+    @api.model
+    def process_chunk(self, references):
+        """Claims and applies the pending changes of the referenced records, deletes them in one statement"""
+        self.env.cr.execute("""
+            UPDATE azure_ad_change_queue_item
+               SET status = 'processing'
+             WHERE record IN %s AND (status IS NULL OR status != 'processing')
+         RETURNING id, record
+        """, (tuple(references),))
+
+        record_change_ids = {}
+
+        for change_id, reference in self.env.cr.fetchall():
+            record_change_ids.setdefault(reference, []).append(change_id)
+
+        change_ids = [change_id for ids in record_change_ids.values() for change_id in ids]
+        self.invalidate_cache(['status'], change_ids)
+
+        # Records removed since their change was queued are skipped
+        for reference, ids in record_change_ids.items():
+            record = self.browse_reference(reference)
+
+            if record:
+                self.process_record_changes(record, self.browse(sorted(ids)))
+
+        if change_ids:
+            self.flush()
+            self.env.cr.execute('DELETE FROM azure_ad_change_queue_item WHERE id IN %s', (tuple(change_ids),))
+            self.invalidate_cache(ids=change_ids)
+
+        _logger.info('AzureAD Processed %s changes of %s records' % (len(change_ids), len(record_change_ids)))
+
+        return len(record_change_ids)
+
+    @api.model
+    def get_change_batch_size(self):
+        """Returns the amount of change items read per chunk of process_queue"""
+        return max(int(self.env['ir.config_parameter'].sudo().get_param('office365.change.batch_size', DEFAULT_CHANGE_BATCH_SIZE)), 1)
+
+    # -------
+    # HELPERS
+    # -------
+    @api.model
+    def browse_reference(self, reference):
+        """Returns the existing record of a 'model,id' reference, ids of virtual records are kept as strings"""
+        res_model, res_id = reference.split(',')
 
-        for item in queue_items:
-            record_changes.setdefault(item.record, [])
-            record_changes[item.record].append(item)
+        try:
+            res_id = int(res_id)
+        except ValueError:
+            pass
 
-        for record, changes in record_changes.items():
-            self.process_record_changes(record, changes)
+        return self.env[res_model].browse(res_id).exists()
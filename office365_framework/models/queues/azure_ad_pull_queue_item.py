@@ -1,10 +1,16 @@
 # See LICENSE file for full copyright and licensing details.
 import logging
+from datetime import timedelta
 
 from odoo import models, fields, api
 
+from ..concurrency import get_sync_workers, run_for_users
+
 _logger = logging.getLogger(__name__)
 
+# Seconds after which a pulling item is considered abandoned by a killed worker
+DEFAULT_PULL_STALE_TIMEOUT = 3600
+
 
 class AzureAdPullQueueItem(models.Model):
     _name = 'azure.ad.pull.queue.item'
@@ -41,7 +47,7 @@ class AzureAdPullQueueItem(models.Model):
         if len(res) == 0:
             res = self.create({'user_id': user_id})
 
-        if res.status != 'pulling':
+        if res.status != 'pulling' or res.is_stale():
             res.write({'status': 'pulling'})
 
             processed = res.process()
@@ -49,7 +55,8 @@ class AzureAdPullQueueItem(models.Model):
             try:
                 return sum([sum(u) for u in processed])
             except TypeError:
-                pass
+                if isinstance(processed, int):
+                    return processed
 
         return 0
 
@@ -61,7 +68,9 @@ class AzureAdPullQueueItem(models.Model):
 
         queue_items = self.search([])
         queue_items.write({'status': 'pulling'})
-        queue_items.process()
+
+        for queue_item in queue_items:
+            queue_item.process()
 
         # WEBHOOK Unlock
 
@@ -70,9 +79,34 @@ class AzureAdPullQueueItem(models.Model):
 
     @api.model
     def process_for_all_users(self):
-        users = self.env['azure.ad.user'].search([('azure_ad_sync_started', '=', True)])
+        # Throttled users are skipped, they are pulled again with the next run
+        users = self.env['azure.ad.user'].search([('azure_ad_sync_started', '=', True)] + self.env['azure.ad.user'].get_not_throttled_domain())
+        workers = get_sync_workers(self.env)
+
+        # Pull users concurrently, each in its own transaction
+        if workers > 1 and len(users) > 1:
+            # Records shared between users, like meetings and attendees, are created one transaction at a time
+            run_for_users(self.env, users.ids, lambda env, user_id: env['azure.ad.pull.queue.item'].with_context(office365_concurrent_pull=True, office365_commit_checkpoints=True).pull_for_user(user_id), workers)
+
+            # Start a new transaction, so the change items committed by the workers are visible
+            self.env.cr.commit()
+            self.env['azure.ad.change.queue.item'].sudo().process_queue()
 
-        for user in users:
+            return
+
+        # Users whose item was left by an interrupted run are pulled with that item
+        for user in users - self.search([('user_id', 'in', users.ids)]).mapped('user_id'):
             self.create({'user_id': user.id})
 
-        self.process_queue()
+        # Commit every pulled page with its checkpoint
+        self.with_context(office365_commit_checkpoints=True).process_queue()
+
+    # -------
+    # HELPERS
+    # -------
+    def is_stale(self):
+        """Returns whether the item is pulling for longer than office365.pull.stale.timeout seconds, e.g. because its worker was killed"""
+        self.ensure_one()
+        timeout = int(self.env['ir.config_parameter'].sudo().get_param('office365.pull.stale.timeout', DEFAULT_PULL_STALE_TIMEOUT))
+
+        return self.status == 'pulling' and self.write_date < fields.Datetime.now() - timedelta(seconds=timeout)
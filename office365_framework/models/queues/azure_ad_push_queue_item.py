@@ -1,11 +1,27 @@
 # See LICENSE file for full copyright and licensing details.
+import json
+import logging
+import random
 import traceback
+from datetime import timedelta
+
+import psycopg2
 
 from ..exceptions import *
-from odoo import models, fields, api
+from ..concurrency import get_sync_workers, run_for_users, schedule_push
+from odoo import models, fields, api, tools
 
+_logger = logging.getLogger(__name__)
 
 MAX_PUSH_AMOUNT = 50
+DEFAULT_PUSH_RUN_LIMIT = 500
+PENDING_STATUSES = ['waiting', 'retrying']
+
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BACKOFF_BASE = 60
+MAX_BACKOFF = 6 * 3600
+
+DEFAULT_LEASE_DURATION = 900
 
 
 class AzureAdPushQueueItem(models.Model):
@@ -15,9 +31,10 @@ class AzureAdPushQueueItem(models.Model):
     user_id = fields.Many2one(comodel_name='azure.ad.user', string='User', index=True, required=True, ondelete='cascade')
     data_domain = fields.Char(string="Azure AD Domain")
     data_id = fields.Char(string="Azure AD ID")
+    parent_data_id = fields.Char(string="Azure AD Parent ID", index=True, help='Id of the parent resource in the domain, e.g. the calendar of calendars/<id>/events')
     data = fields.Char(string='Data')
     last_error = fields.Char(string='Last Error')
-    link = fields.Many2one(comodel_name='azure.ad.user.record.link', string='Record Link')
+    link = fields.Many2one(comodel_name='azure.ad.user.record.link', string='Record Link', index=True)
     headers = fields.Char(string='Extra Applied Headers')
     method = fields.Selection(selection=[
         ('POST', 'POST'),
@@ -33,48 +50,320 @@ class AzureAdPushQueueItem(models.Model):
         ('failed', 'Processing Failed'),
         ('retrying', 'Processing Failed - Awaiting New Attempt')], default='waiting')
 
+    attempt_count = fields.Integer(string='Failed Attempts', default=0)
+    next_attempt_at = fields.Datetime(string='Next Attempt', index=True)
+    lease_expires_at = fields.Datetime(string='Processing Lease Expires', help='Processing items past their lease are claimed again, their worker is considered gone')
+
+    @api.model
+    def create(self, vals):
+        if 'parent_data_id' not in vals:
+            vals['parent_data_id'] = self.env['azure.ad.user'].extract_parent_data_id(vals.get('data_domain'), vals.get('data_id'))
+
+        res = super(AzureAdPushQueueItem, self).create(vals)
+
+        # Push soon after the transaction commits instead of waiting for the cron
+        schedule_push(self.env, res.user_id.ids)
+
+        return res
+
+    def init(self):
+        # Pending items are looked up per user and status, the queue keeps the history of failed and cancelled items
+        tools.create_index(self._cr, 'azure_ad_push_queue_item_user_status_create_date_index', self._table, ['user_id', 'status', 'create_date'])
+
     # ---------------------
     # Process Push for User
     # ---------------------
     @api.model
-    def process(self, user):
+    def process(self, user, limit=None):
+        """Pushes the pending items of the user in chunks of MAX_PUSH_AMOUNT, at most limit items per run"""
         if isinstance(user, int):
             user = self.env['azure.ad.user'].browse(user)
 
-        # Limit to Office 365 Maximum Request Amount
-        queue_items = user.push_queue_item_ids.filtered(lambda i: i.status in ['waiting', 'retrying'])
-        queue_items.write({'status': 'processing'})
+        limit = limit or self.get_push_run_limit()
+
+        self.coalesce(user)
 
         processed = 0
+        fetched = 0
+        last_id = 0
+
+        # Items that fail in this run are not selected again, the next run picks them up
+        while fetched < limit:
+            queue_items = self.claim(user, last_id, min(MAX_PUSH_AMOUNT, limit - fetched))
+
+            if not queue_items:
+                break
+
+            last_id = queue_items[-1].id
+            fetched += len(queue_items)
+
+            chunk_processed = self.process_items(user, queue_items)
+
+            # The whole batch failed, later chunks would fail as well
+            if chunk_processed is False:
+                break
+
+            processed += chunk_processed
+
+        return processed
+
+    @api.model
+    def claim(self, user, last_id, limit):
+        """Claims due items of the user after last_id for this transaction, ordered by id.
+
+        Rows locked by other workers are skipped, so concurrent workers push disjoint items. Processing items
+        whose lease expired are claimed again. Patches and deletes of a link whose pending POST has not returned an
+        Outlook id yet wait for it, even when another worker holds that POST."""
+        now = fields.Datetime.now()
+        lease_expires_at = now + timedelta(seconds=self.get_push_lease_duration())
+
+        self.flush()
 
         try:
-            results = user.batch_request(push_items=queue_items)
+            with self.env.cr.savepoint():
+                self.env.cr.execute("""
+                    UPDATE azure_ad_push_queue_item
+                       SET status = 'processing', lease_expires_at = %s, write_uid = %s, write_date = %s
+                     WHERE id IN (
+                        SELECT item.id FROM azure_ad_push_queue_item item
+                         WHERE item.user_id = %s AND item.id > %s
+                           AND ((item.status IN %s AND (item.next_attempt_at IS NULL OR item.next_attempt_at <= %s))
+                                OR (item.status = 'processing' AND (item.lease_expires_at IS NULL OR item.lease_expires_at < %s)))
+                           AND NOT (item.method IN ('PATCH', 'DELETE') AND item.data_id IS NULL AND EXISTS (
+                                SELECT 1 FROM azure_ad_push_queue_item post
+                                  JOIN azure_ad_user_record_link link ON link.id = post.link
+                                 WHERE post.link = item.link AND post.method = 'POST' AND post.status IN %s AND link.data_id IS NULL))
+                         ORDER BY item.id
+                         LIMIT %s
+                           FOR UPDATE OF item SKIP LOCKED)
+                 RETURNING id
+                """, (lease_expires_at, self.env.uid, now, user.id, last_id, tuple(PENDING_STATUSES), now, now, tuple(PENDING_STATUSES + ['processing']), limit), log_exceptions=False)
+        except psycopg2.OperationalError:
+            # Items changed by a concurrent transaction since this one started, leave them to the next run
+            _logger.info('AzureAD Push items of user %s are being processed by another worker' % user.id)
+
+            return self.browse()
+
+        ids = sorted(row[0] for row in self.env.cr.fetchall())
+        self.invalidate_cache(['status', 'lease_expires_at', 'write_uid', 'write_date'], ids)
+
+        return self.browse(ids)
+
+    @api.model
+    def process_items(self, user, queue_items):
+        """Sends the claimed queue items in one batch request, returns the amount processed or False if the batch failed"""
+        processed = 0
+
+        try:
+            results = user.batch_request(push_items=queue_items, partial=True)
+        except RequestDeferredError as e:
+            # Nothing was sent, wait for the scheduler without using up an attempt
+            queue_items.schedule_retry(str(e), e.retry_after, count_attempt=False)
+
+            return False
         except Exception as e:
-            queue_items.write({'status': 'retrying', 'last_error': str(e)})
-        else:
-            if len(results) != len(queue_items):
-                raise Exception("Batch Request Failed, returned result and queue item length does not match!")
+            queue_items.schedule_retry(str(e), getattr(e, 'retry_after', None))
+
+            return False
 
-            for item, result in zip(queue_items, results):
-                try:
-                    user.process_response(result)
+        if len(results) != len(queue_items):
+            raise Exception("Batch Request Failed, returned result and queue item length does not match!")
 
-                    item.unlink()
+        # Every envelope failed, later chunks would fail as well
+        if all(isinstance(result, Exception) for result in results):
+            queue_items.schedule_retry(str(results[0]), getattr(results[0], 'retry_after', None))
 
-                    processed += 1
-                except (ThrottleError, ServerError, AuthenticationError) as recoverable_error:
-                    item.write({'status': 'retrying', 'last_error': recoverable_error.message})
-                except Exception as e:
-                    item.write({'status': 'failed', 'last_error': str(e)})
+            return False
+
+        for item, result in zip(queue_items, results):
+            # The envelope of the item failed, only its items are sent again
+            if isinstance(result, Exception):
+                item.schedule_retry(str(result), getattr(result, 'retry_after', None))
+
+                continue
+
+            try:
+                user.process_response(result)
+
+                item.unlink()
+
+                processed += 1
+            except (ThrottleError, ServerError, AuthenticationError) as recoverable_error:
+                item.schedule_retry(str(recoverable_error), getattr(recoverable_error, 'retry_after', None))
+            except Exception as e:
+                item.write({'status': 'failed', 'last_error': str(e)})
 
         return processed
 
+    # ----------
+    # Coalescing
+    # ----------
+    @api.model
+    def coalesce(self, user):
+        """Folds the pending items of every link of the user into the minimal operation, returns the amount removed"""
+        queue_items = self.search(self.get_pending_domain(user) + [('link', '!=', False), ('method', 'in', ['POST', 'PATCH', 'DELETE'])], order='id').lock_skip_locked()
+
+        link_items = {}
+        for item in queue_items:
+            link_items.setdefault(item.link, []).append(item)
+
+        redundant = self.browse()
+        cancelled_links = self.env['azure.ad.user.record.link']
+
+        for link, items in link_items.items():
+            if len(items) < 2:
+                continue
+
+            kept, data, link_items_redundant = self.fold_link_items(link, items)
+
+            if kept and data != kept.data:
+                kept.data = data
+
+            # POST followed by DELETE, the record never reached Outlook
+            if not kept:
+                cancelled_links |= link
+
+            redundant |= link_items_redundant
+
+        if redundant:
+            _logger.info('AzureAD Coalesced %s push items of user %s' % (len(redundant), user.id))
+
+            redundant.unlink()
+            cancelled_links.unlink()
+
+        return len(redundant)
+
+    @api.model
+    def fold_link_items(self, link, items):
+        """Folds the items of one link, ordered by creation, returns the remaining item with its data and the redundant items.
+
+        POST + PATCH becomes POST, PATCH + PATCH becomes PATCH, PATCH + DELETE becomes DELETE, POST + DELETE becomes nothing,
+        anything after a DELETE is dropped. Payloads are combined with the merge of the record link."""
+        kept = None
+        data = None
+        cancelled = False
+        redundant = self.browse()
+
+        for item in items:
+            if cancelled or (kept and kept.method == 'DELETE'):
+                redundant |= item
+            elif not kept:
+                kept, data = item, item.data
+            elif item.method == 'DELETE':
+                redundant |= kept
+
+                if kept.method == 'POST':
+                    redundant |= item
+                    kept, data, cancelled = None, None, True
+                else:
+                    kept, data = item, item.data
+            elif item.method == 'PATCH' or item.method == kept.method:
+                data = json.dumps(link.merge(json.loads(data or '{}') or {}, json.loads(item.data or '{}') or {}))
+                redundant |= item
+            else:
+                # A POST after a PATCH recreates the record, keep the remaining items as they are
+                break
+
+        return kept, data, redundant
+
+    def lock_skip_locked(self):
+        """Returns the items that could be locked for this transaction, items held or changed by other workers are left out"""
+        if not self:
+            return self
+
+        self.flush()
+
+        try:
+            with self.env.cr.savepoint():
+                self.env.cr.execute('SELECT id FROM azure_ad_push_queue_item WHERE id IN %s FOR UPDATE SKIP LOCKED', (tuple(self.ids),), log_exceptions=False)
+        except psycopg2.OperationalError:
+            return self.browse()
+
+        locked = {row[0] for row in self.env.cr.fetchall()}
+
+        return self.filtered(lambda item: item.id in locked)
+
+    # -------
+    # Backoff
+    # -------
+    def schedule_retry(self, last_error, retry_after=None, count_attempt=True):
+        """Schedules the next attempt with a jittered exponential backoff, items out of attempts are marked failed.
+
+        Without count_attempt, for requests held back before they were sent, the attempt count is kept and the item is
+        retried after retry_after"""
+        max_attempts = self.get_push_max_attempts()
+        backoff_base = self.get_push_backoff_base()
+        now = fields.Datetime.now()
+
+        for item in self:
+            attempt_count = item.attempt_count + 1 if count_attempt else item.attempt_count
+
+            if count_attempt and attempt_count >= max_attempts:
+                item.write({'status': 'failed', 'attempt_count': attempt_count, 'next_attempt_at': False, 'last_error': last_error})
+                continue
+
+            delay = min(backoff_base * 2 ** (attempt_count - 1), MAX_BACKOFF) * random.uniform(0.5, 1.0) if count_attempt else 0
+            next_attempt_at = now + timedelta(seconds=max(delay, retry_after or 0))
+
+            # Don't retry before Outlook accepts requests of the mailbox again
+            if item.user_id.throttled_until and item.user_id.throttled_until > next_attempt_at:
+                next_attempt_at = item.user_id.throttled_until
+
+            item.write({'status': 'retrying', 'attempt_count': attempt_count, 'next_attempt_at': next_attempt_at, 'last_error': last_error})
+
+    @api.model
+    def get_pending_domain(self, user):
+        return [('user_id', '=', user.id), ('status', 'in', PENDING_STATUSES)]
+
+    @api.model
+    def get_due_domain(self, user=None):
+        """Pending items whose backoff has passed and processing items past their lease, for all users if none is given"""
+        now = fields.Datetime.now()
+        domain = [
+            '|',
+            '&', ('status', 'in', PENDING_STATUSES), '|', ('next_attempt_at', '=', False), ('next_attempt_at', '<=', now),
+            '&', ('status', '=', 'processing'), '|', ('lease_expires_at', '=', False), ('lease_expires_at', '<', now),
+        ]
+
+        if user:
+            domain = [('user_id', '=', user.id)] + domain
+
+        return domain
+
+    @api.model
+    def get_push_lease_duration(self):
+        """Returns the seconds a worker may hold claimed items, after which other workers claim them again"""
+        return int(self.env['ir.config_parameter'].sudo().get_param('office365.push.lease.duration', DEFAULT_LEASE_DURATION))
+
+    @api.model
+    def get_push_max_attempts(self):
+        return max(int(self.env['ir.config_parameter'].sudo().get_param('office365.push.max.attempts', DEFAULT_MAX_ATTEMPTS)), 1)
+
+    @api.model
+    def get_push_backoff_base(self):
+        """Returns the delay in seconds before the first retry, doubled with every failed attempt"""
+        return float(self.env['ir.config_parameter'].sudo().get_param('office365.push.backoff.base', DEFAULT_BACKOFF_BASE))
+
+    @api.model
+    def get_push_run_limit(self):
+        """Returns the maximum amount of items pushed for one user per run"""
+        return max(int(self.env['ir.config_parameter'].sudo().get_param('office365.push.run.limit', DEFAULT_PUSH_RUN_LIMIT)), 1)
+
     # ----------------------
     # Cron Triggered Methods
     # ----------------------
     @api.model
     def process_queue(self):
-        queue_users = self.env['azure.ad.user'].search([('push_queue_item_ids', '!=', False), ('azure_ad_sync_started', '=', True)])
+        # Only users with items that are due, throttled users are deferred until Outlook accepts their requests again
+        due_user_ids = [group['user_id'][0] for group in self.read_group(self.get_due_domain(), ['user_id'], ['user_id'])]
+        queue_users = self.env['azure.ad.user'].search([('id', 'in', due_user_ids), ('azure_ad_sync_started', '=', True)] + self.env['azure.ad.user'].get_not_throttled_domain())
+        workers = get_sync_workers(self.env)
+
+        # Push users concurrently, each in its own transaction
+        if workers > 1 and len(queue_users) > 1:
+            run_for_users(self.env, queue_users.ids, lambda env, user_id: env['azure.ad.push.queue.item'].process(user_id), workers)
+
+            return
 
         for user in queue_users:
             try:
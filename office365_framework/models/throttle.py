@@ -0,0 +1,130 @@
+# See LICENSE file for full copyright and licensing details.
+import threading
+import time
+
+# Outlook allows 10000 requests per 10 minutes for a mailbox
+DEFAULT_MAILBOX_RATE = 16
+# Shared by all mailboxes of a tenant, keeps a process from flooding the tenant when many mailboxes sync at once
+DEFAULT_TENANT_RATE = 100
+# Seconds the other mailboxes of a tenant pause after one of them was throttled
+DEFAULT_TENANT_BACKOFF = 5
+DEFAULT_MAX_WAIT = 10
+DEFAULT_RETRY_AFTER = 60
+
+
+class TokenBucket:
+    """Token bucket refilling rate tokens per second, up to a burst of capacity tokens.
+
+    Requests reserve their tokens immediately and wait for the debt to be refilled, so concurrent callers are
+    served in order of arrival."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, cost=1, max_wait=None):
+        """Reserves cost tokens, returns the seconds to wait before sending or None if that exceeds max_wait"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            wait = max(cost - self.tokens, 0) / self.rate
+
+            if max_wait is not None and wait > max_wait:
+                return None
+
+            self.tokens -= cost
+
+            return wait
+
+    def release(self, cost=1):
+        """Gives back tokens reserved for a request that was not sent"""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + cost)
+
+    def drain(self):
+        """Empties the bucket, used when the service signals throttling"""
+        with self._lock:
+            self.tokens = min(self.tokens, 0)
+            self.updated = time.monotonic()
+
+
+class AzureAdThrottle:
+    """Request scheduler of the current process, with a bucket per mailbox and per tenant"""
+
+    _lock = threading.Lock()
+    _buckets = {}
+    _throttled_until = {}
+
+    def __init__(self, mailbox_rate=DEFAULT_MAILBOX_RATE, tenant_rate=DEFAULT_TENANT_RATE, max_wait=DEFAULT_MAX_WAIT, tenant_backoff=DEFAULT_TENANT_BACKOFF):
+        self.mailbox_rate = mailbox_rate
+        self.tenant_rate = tenant_rate
+        self.max_wait = max_wait
+        self.tenant_backoff = tenant_backoff
+
+    def get_bucket(self, key, rate):
+        if not rate or rate <= 0:
+            return None
+
+        with self._lock:
+            bucket = self._buckets.get(key)
+
+            if bucket is None or bucket.rate != rate:
+                bucket = self._buckets[key] = TokenBucket(rate)
+
+        return bucket
+
+    def acquire(self, mailbox_key, tenant_key, cost=1):
+        """Waits until the request may be sent. Returns 0 when it was scheduled, otherwise the seconds to retry after"""
+        remaining = max(self.get_throttled_until(mailbox_key), self.get_throttled_until(tenant_key)) - time.time()
+
+        if remaining > 0:
+            return remaining
+
+        wait = 0
+        reserved = []
+
+        for key, rate in [(mailbox_key, self.mailbox_rate), (tenant_key, self.tenant_rate)]:
+            bucket = self.get_bucket(key, rate)
+
+            if bucket:
+                bucket_wait = bucket.reserve(cost, self.max_wait)
+
+                if bucket_wait is None:
+                    # Not sent, the buckets that accepted it get their tokens back
+                    for reserved_bucket in reserved:
+                        reserved_bucket.release(cost)
+
+                    # 0 means scheduled, a rejection always asks for a retry later
+                    return max(self.max_wait, 1)
+
+                reserved.append(bucket)
+                wait = max(wait, bucket_wait)
+
+        if wait:
+            time.sleep(wait)
+
+        return 0
+
+    def set_throttled(self, mailbox_key, tenant_key, retry_after):
+        """Blocks the mailbox for retry_after seconds, pauses the other mailboxes of the tenant for a short back-off and
+        slows them down afterwards"""
+        now = time.time()
+
+        with self._lock:
+            self._throttled_until[mailbox_key] = max(self._throttled_until.get(mailbox_key, 0), now + retry_after)
+
+            if self.tenant_backoff and self.tenant_backoff > 0:
+                self._throttled_until[tenant_key] = max(self._throttled_until.get(tenant_key, 0), now + min(retry_after, self.tenant_backoff))
+
+        bucket = self.get_bucket(tenant_key, self.tenant_rate)
+
+        if bucket:
+            bucket.drain()
+
+    def get_throttled_until(self, key):
+        return self._throttled_until.get(key, 0)
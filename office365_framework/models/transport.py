@@ -0,0 +1,85 @@
+# See LICENSE file for full copyright and licensing details.
+import logging
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .exceptions import ServerError
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+
+class AzureAdTransport:
+    """HTTP transport shared by all Azure AD users of the current process.
+
+    Keeps one pooled keep-alive session per remote host, so consecutive requests to
+    login.microsoftonline.com or outlook.office.com reuse their TCP/TLS connections."""
+
+    _lock = threading.Lock()
+    _sessions = {}
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, keep_alive=True, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def request(self, method, url, headers=None, data=None):
+        """Performs the request on the pooled session of the url's host"""
+        headers = dict(headers or {})
+
+        if not self.keep_alive:
+            headers['Connection'] = 'close'
+
+        try:
+            return self.get_session(url).request(method, url, headers=headers, data=data, timeout=(self.connect_timeout, self.read_timeout))
+        except requests.exceptions.Timeout as e:
+            raise ServerError('Request timed out: %s %s (%s)' % (method, url, e))
+        except requests.exceptions.ConnectionError as e:
+            raise ServerError('Connection failed: %s %s (%s)' % (method, url, e))
+
+    def get_session(self, url):
+        """Returns the session for the host of the url, creates it if the pool settings changed"""
+        parts = urlsplit(url)
+        prefix = '%s://%s' % (parts.scheme, parts.netloc)
+
+        with self._lock:
+            pool_size, session = self._sessions.get(prefix, (None, None))
+
+            if session is None or pool_size != self.pool_size:
+                if session is not None:
+                    session.close()
+
+                session = self.create_session(prefix)
+                self._sessions[prefix] = (self.pool_size, session)
+
+                _logger.debug('AzureAD Opened HTTP pool for %s with size %s' % (prefix, self.pool_size))
+
+        return session
+
+    def create_session(self, prefix):
+        session = requests.Session()
+
+        # Ask for compressed responses, urllib3 decompresses them transparently
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+        # Sessions are shared between mailboxes, cookies set for one user should never be sent for another
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+
+        return session
+
+    @classmethod
+    def close_all(cls):
+        with cls._lock:
+            for pool_size, session in cls._sessions.values():
+                session.close()
+
+            cls._sessions.clear()
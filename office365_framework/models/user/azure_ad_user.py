@@ -3,25 +3,46 @@ import base64
 import hashlib
 import json
 import re
+import threading
 import time
 import traceback
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from random import random
 
-import requests
 import werkzeug
 
-from odoo import models, fields, api, _
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import ValidationError
 from ..exceptions import *
+from ..transport import AzureAdTransport, DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+from ..cache import LRUCache
+from ..batch import BATCH_MAX_REQUESTS, encode_batch, encode_batch_request, decode_batch
+from ..concurrency import fetch_committed
+from ..throttle import AzureAdThrottle, DEFAULT_MAILBOX_RATE, DEFAULT_TENANT_RATE, DEFAULT_MAX_WAIT, DEFAULT_RETRY_AFTER, DEFAULT_TENANT_BACKOFF
 
 AZURE_AD_AUTH_ENDPOINT = 'https://login.microsoftonline.com/common/oauth2/v2.0/authorize'
 AZURE_AD_TOKEN_ENDPOINT = 'https://login.microsoftonline.com/common/oauth2/v2.0/token'
 AZURE_AD_SCOPE = 'openid offline_access profile email'
 OUTLOOK_ENDPOINT = 'https://outlook.office.com/api/v2.0/me/'
 
+# Amount of $batch requests sent concurrently per mailbox, Outlook allows up to 4
+DEFAULT_BATCH_CONCURRENCY = 1
+
+# Seconds before expiry at which the refresh cron renews an access token
+DEFAULT_TOKEN_REFRESH_MARGIN = 1200
+
 _logger = logging.getLogger(__name__)
 
+# Per worker caches: expiration time of decoded tokens, and tokens refreshed by this worker per (database, user)
+_token_expiration_cache = LRUCache(max_size=2048)
+_refreshed_token_cache = LRUCache(max_size=2048)
+
+_refresh_locks = {}
+_refresh_locks_lock = threading.Lock()
+
 
 class AzureAdUser(models.Model):
     _name = 'azure.ad.user'
@@ -38,9 +59,12 @@ class AzureAdUser(models.Model):
 
     id_token = fields.Char(string="ID Token")
     access_token = fields.Char(string="Access Token")
+    access_token_expiration = fields.Integer(string="Access Token Expiration (Epoch)", index=True)
     refresh_token = fields.Char(string="Refresh Token")
 
     email = fields.Char(string="Email")
+    tenant_id = fields.Char(string="Tenant Id")
+    throttled_until = fields.Datetime(string="Throttled Until", index=True)
     outlook_category = fields.Char('Outlook Category Name', default="Odoo")
     azure_ad_sync_started = fields.Boolean(string='Synchronisation of Outlook')
     record_link_ids = fields.One2many(comodel_name='azure.ad.user.record.link', inverse_name='user_id', string='Azure AD Record Links')
@@ -51,6 +75,10 @@ class AzureAdUser(models.Model):
 
     partner_id = fields.Many2one(comodel_name='res.partner', string='Odoo User', ondelete='cascade')
 
+    def init(self):
+        # Attendees are matched case insensitively on the email of their Azure AD user
+        tools.create_index(self._cr, 'azure_ad_user_lower_email_index', self._table, ['lower(email)'])
+
     # -----------
     # Token Logic
     # -----------
@@ -90,12 +118,16 @@ class AzureAdUser(models.Model):
             self.authentication_failure = True
             return
 
+        expiration = self.get_response_expiration_time(response)
+
         try:
             self.write({
                 'refresh_token': response['refresh_token'],
                 'access_token': response['access_token'],
+                'access_token_expiration': expiration,
                 'id_token': response['id_token'],
                 'email': jwt['payload']['preferred_username'],
+                'tenant_id': jwt['payload'].get('tid'),
                 'authentication_failure': False
             })
         except Exception as e:
@@ -106,6 +138,86 @@ class AzureAdUser(models.Model):
             self.authentication_failure = True
             return
 
+        _refreshed_token_cache.set((self.env.cr.dbname, self.id), (response['access_token'], expiration))
+
+    def ensure_access_token(self, margin=0):
+        """Returns an access token that is valid for at least margin seconds, refreshes it when needed.
+
+        Refreshes of the same user are serialised within the worker by a lock, and between workers by an advisory
+        lock on the user. When another worker is already refreshing, the token is only renewed in memory if the current
+        one has expired, so the transactions never compete for the same row."""
+        self.ensure_one()
+
+        token = self.get_valid_access_token(margin)
+
+        if token or not self.refresh_token:
+            return token or self.access_token
+
+        with self.get_refresh_lock():
+            # Another thread of this worker could have refreshed the token while waiting for the lock
+            token = self.get_valid_access_token(margin)
+
+            if token:
+                return token
+
+            if self.lock_for_refresh():
+                self.set_access_token()
+            elif not self.get_valid_access_token():
+                self.set_access_token_in_memory()
+
+        return self.get_valid_access_token() or self.access_token
+
+    def get_valid_access_token(self, margin=0):
+        """Returns the most recent known access token if it is still valid for margin seconds, otherwise False"""
+        self.ensure_one()
+
+        candidates = [(self.access_token, self.access_token_expiration or self.get_token_expiration_time(self.access_token))]
+
+        refreshed = _refreshed_token_cache.get((self.env.cr.dbname, self.id))
+        if refreshed:
+            candidates.append(refreshed)
+
+        token, expiration = max(candidates, key=lambda c: c[1] or 0)
+
+        if token and self.check_epoch_time_still_valid((expiration or 0) - margin):
+            return token
+
+        return False
+
+    def get_refresh_lock(self):
+        key = (self.env.cr.dbname, self.id)
+
+        with _refresh_locks_lock:
+            return _refresh_locks.setdefault(key, threading.Lock())
+
+    def lock_for_refresh(self):
+        """Takes the refresh lock of the user for the current transaction, returns False if another transaction holds it or
+        already committed a newer token.
+
+        An advisory lock, unlike a row lock, does not block the other writes to the user while the token is requested."""
+        self.env.cr.execute("SELECT pg_try_advisory_xact_lock(hashtext('azure_ad_user_refresh'), %s)", (self.id,))
+
+        if not self.env.cr.fetchone()[0]:
+            _logger.info('AzureAD Token of user %s is being refreshed by another worker' % self.id)
+
+            return False
+
+        # Refreshed and committed by another worker after this transaction started, use its token
+        rows = fetch_committed(self.env, 'SELECT access_token, access_token_expiration FROM azure_ad_user WHERE id = %s', (self.id,))
+
+        if rows and rows[0][0] and (rows[0][1] or 0) > (self.access_token_expiration or 0):
+            _refreshed_token_cache.set((self.env.cr.dbname, self.id), rows[0])
+
+            return False
+
+        return True
+
+    def set_access_token_in_memory(self):
+        """Gets a new Access Token without storing it, used while another transaction stores its own refresh"""
+        response = self.get_token('refresh_token', 'refresh_token', self.refresh_token)
+
+        _refreshed_token_cache.set((self.env.cr.dbname, self.id), (response['access_token'], self.get_response_expiration_time(response)))
+
     @api.model
     def get_token(self, grant_type, code_type, code):
         """Calls the Azure AD Token Endpoint"""
@@ -118,7 +230,7 @@ class AzureAdUser(models.Model):
             'redirect_uri': self.get_login_redirect_url(),
         }
 
-        response = requests.post(AZURE_AD_TOKEN_ENDPOINT, data=params)
+        response = self.get_transport().request('POST', AZURE_AD_TOKEN_ENDPOINT, data=params)
 
         try:
             body = response.json()
@@ -133,10 +245,10 @@ class AzureAdUser(models.Model):
     # Requests
     # --------
     # GET
-    def get_data(self, domain=None, url=None, data_id=None, headers=None):
-        """Performs a GET Request to the Azure AD Endpoint for this user."""
+    def get_data(self, domain=None, url=None, data_id=None, headers=None, select=None):
+        """Performs a GET Request to the Azure AD Endpoint for this user, select limits the returned properties."""
 
-        return self.aad_request(method='GET', url=url, domain=domain, data_id=data_id, headers=headers, force=True)
+        return self.aad_request(method='GET', url=self.add_select(url, select), domain=self.add_select(domain, select), data_id=data_id, headers=headers, force=True)
 
     # POST
     def post_data(self, domain, data, data_id=None, link=None, force=False):
@@ -153,13 +265,13 @@ class AzureAdUser(models.Model):
         # Find Links depending on data_id, remove them
         if data_id:
             # Find queue items for this data_id, cancel them
-            self.env['azure.ad.push.queue.item'].search([('data_domain', 'like', data_id), ('status', 'in', ['waiting', 'retrying'])]).write({'status': 'cancelled', 'last_error': 'Parent deleted by AadRequest'})
+            self.env['azure.ad.push.queue.item'].search([('parent_data_id', '=', data_id), ('status', 'in', ['waiting', 'retrying'])]).write({'status': 'cancelled', 'last_error': 'Parent deleted by AadRequest'})
             self.env['azure.ad.push.queue.item'].search([('data_id', '=', data_id), ('status', 'in', ['waiting', 'retrying'])]).write({'status': 'cancelled', 'last_error': 'Deleted by AadRequest'})
 
             if escalate:
-                self.env['azure.ad.user.record.link'].sudo().search([('create_domain', 'like', data_id)]).delete()
+                self.env['azure.ad.user.record.link'].sudo().search([('parent_data_id', '=', data_id)]).delete()
             else:
-                self.env['azure.ad.user.record.link'].sudo().search([('create_domain', 'like', data_id)]).unlink()
+                self.env['azure.ad.user.record.link'].sudo().search([('parent_data_id', '=', data_id)]).unlink()
 
             return self.aad_request(method='DELETE', domain=domain, data_id=data_id, force=force, link=link)
         else:
@@ -173,38 +285,54 @@ class AzureAdUser(models.Model):
 
     # SYNC
     def sync_request(self, domain=None, url=None, data=None, headers=None):
+        """Returns all pages of a delta request merged in one result, prefer sync_pages for large deltas"""
+        sync_data = None
+
+        for page in self.sync_pages(domain=domain, url=url, headers=headers):
+            if sync_data is not None:
+                page['value'] = sync_data['value'] + page['value']
+
+            sync_data = page
+
+        if data:
+            sync_data['value'].extend(data['value'])
+
+        return sync_data
+
+    def sync_pages(self, domain=None, url=None, headers=None):
+        """Yields the pages of a delta request as they arrive, follows @odata.nextLink until the @odata.deltaLink"""
         sync_headers = {'Prefer': 'odata.track-changes, odata.maxpagesize=200, outlook.body-content-type="text"'}
 
         if headers:
             sync_headers.update(headers)
 
-        try:
-            sync_data = self.aad_request(method='GET', domain=domain, url=url, force=True, headers=sync_headers)
-        except NotFoundError as e:
-            # Check if sync point is gone
-            if e.status_code == 410:
-                # Do request again, without deltatoken
-                delta_removed = re.sub(r'&?(%24|&)?deltatoken=[^&]*', '', url or domain, 1, re.IGNORECASE)
-
-                sync_data = self.aad_request(method='GET', domain=delta_removed if domain else None, url=delta_removed if url else None, force=True, headers=sync_headers)
-            else:
-                raise e
+        while True:
+            try:
+                sync_data = self.aad_request(method='GET', domain=domain, url=url, force=True, headers=sync_headers)
+            except NotFoundError as e:
+                # Check if sync point is gone
+                if e.status_code == 410:
+                    # Do request again, without deltatoken
+                    delta_removed = re.sub(r'&?(%24|&)?deltatoken=[^&]*', '', url or domain, 1, re.IGNORECASE)
 
-        if data:
-            sync_data['value'].extend(data['value'])
+                    sync_data = self.aad_request(method='GET', domain=delta_removed if domain else None, url=delta_removed if url else None, force=True, headers=sync_headers)
+                else:
+                    raise e
 
-        # NextLink, more results found
-        if u'@odata.nextLink' in sync_data:
-            return self.sync_request(url=sync_data[u'@odata.nextLink'], data=sync_data, headers=headers)
+            yield sync_data
 
-        # First sync without deltatoken
-        if (url and 'deltaToken' not in url) and (domain and 'deltaToken' not in domain):
-            return self.sync_request(url=sync_data[u'@odata.deltaLink'], data=sync_data, headers=headers)
+            # NextLink, more results found
+            if u'@odata.nextLink' not in sync_data:
+                return
 
-        return sync_data
+            domain, url = None, sync_data[u'@odata.nextLink']
 
     # Perform Batch Request
-    def batch_request(self, push_items=None, batch_requests=None):
+    def batch_request(self, push_items=None, batch_requests=None, partial=False):
+        """Sends the requests in \$batch envelopes of BATCH_MAX_REQUESTS, returns an AzureResponse per request.
+
+        With partial, the requests of an envelope that failed get the exception of the envelope instead of a response,
+        the other envelopes are still returned. Otherwise the first failure is raised once all envelopes were sent."""
         if push_items is None:
             push_items = []
         if batch_requests is None:
@@ -216,35 +344,108 @@ class AzureAdUser(models.Model):
             return []
 
         # Splits into groups of 20
-        batch_groups = [batch_requests[i:i + 20] for i in range(0, len(batch_requests), 20)]
-        returns = []
+        batch_groups = [batch_requests[i:i + BATCH_MAX_REQUESTS] for i in range(0, len(batch_requests), BATCH_MAX_REQUESTS)]
+        envelopes = [self.prepare_batch_envelope(group) for group in batch_groups]
+        concurrency = self.get_batch_concurrency()
 
-        for group in batch_groups:
-            batch_id = uuid.uuid4().hex
-            body = ""
+        # The scheduler allows the whole chunk at once, it never holds back a group after earlier groups were sent
+        self.acquire_request_slot(len(batch_requests))
 
-            for req in group:
-                body += "--batch_%s\n" % batch_id + req.body
+        if concurrency > 1 and len(batch_groups) > 1:
+            responses = self.dispatch_batch_envelopes(envelopes, concurrency)
+        else:
+            responses = self.send_batch_envelopes(envelopes)
 
-            # Newlines required, otherwise microsoft returns JSON parse error
-            body += "--batch_%s--\n\n\n" % batch_id
+        returns = []
 
-            response = self.aad_request(method="POST", domain="$batch", data=body, force=True, headers={"Content-Type": "multipart/mixed; charset=utf-8; boundary=batch_%s " % batch_id, "Prefer": "odata.continue-on-error"})
+        for group, response in zip(batch_groups, responses):
+            if not isinstance(response, Exception):
+                try:
+                    returns.extend(self.parse_batch_response(group, response))
 
-            # Returns individual responses, with the response lines split and empty lines removed
-            responses = [[l for l in r.splitlines() if l != ''] for r in response.split(response.split('\n', 1)[0])[1:]]
+                    continue
+                except Exception as e:
+                    response = e
 
-            # Removes final "--batchresponse_[id]--"
-            responses[-1] = responses[-1][:-1]
+            if not partial:
+                raise response
 
-            # Converts response to list with status/response dict, and adds these to the return list
-            returns.extend([AzureResponse(status_code=int(next(x for x in res if x.startswith("HTTP/1.1"))[9:12]), body=res[-1], method=req.method, link=req.link) for req, res in zip(group, responses)])
+            returns.extend([response] * len(group))
 
         return returns
 
+    def send_batch_envelopes(self, envelopes):
+        """Posts the \$batch envelopes one after the other, returns the response body of every envelope or the exception it
+        failed with. Once Outlook throttles the mailbox, the remaining envelopes are not sent."""
+        responses = []
+
+        for body, headers in envelopes:
+            try:
+                responses.append(self.aad_request(method="POST", domain="$batch", data=body, force=True, headers=headers, scheduled=True))
+            except ThrottleError as e:
+                responses.extend([e] * (len(envelopes) - len(responses)))
+
+                break
+            except Exception as e:
+                responses.append(e)
+
+        return responses
+
+    def prepare_batch_envelope(self, group):
+        """Returns the multipart body and headers of a $batch request for a group of BatchRequests"""
+        batch_id = uuid.uuid4().hex
+        body = encode_batch([req.body for req in group], batch_id)
+
+        return body, {"Content-Type": "multipart/mixed; charset=utf-8; boundary=batch_%s " % batch_id, "Prefer": "odata.continue-on-error"}
+
+    def dispatch_batch_envelopes(self, envelopes, concurrency):
+        """Posts the $batch envelopes concurrently, returns the response body of every envelope or the exception it failed
+        with, in the order of the envelopes.
+
+        Only the HTTP calls run in the threads, the token and the responses are handled in the current environment.
+        The request slots of the envelopes are acquired by the caller."""
+        access_token = self.prepare_access_token()
+        transport = self.get_transport()
+        url = self.form_url(None, '$batch', None, None, 'POST')
+
+        def send(envelope):
+            body, headers = envelope
+            headers = dict(headers, Authorization='Bearer %s' % access_token)
+
+            return transport.request('POST', url, headers=headers, data=body)
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='office365_batch') as executor:
+            futures = [executor.submit(send, envelope) for envelope in envelopes]
+
+        responses = []
+
+        # A failing envelope doesn't discard the responses of the envelopes Outlook already applied
+        for future in futures:
+            try:
+                response = future.result()
+                responses.append(self.process_response(AzureResponse(response.status_code, response.text, 'POST', headers=response.headers)))
+            except Exception as e:
+                responses.append(e)
+
+        return responses
+
+    @api.model
+    def parse_batch_response(self, group, response):
+        """Splits a $batch response in AzureResponses, in the order of the BatchRequests of the group"""
+        parts = decode_batch(response, len(group))
+
+        return [AzureResponse(status_code=part.status_code, body=part.body, method=req.method, link=req.link, headers=part.headers) for req, part in zip(group, parts)]
+
+    @api.model
+    def get_batch_concurrency(self):
+        """Returns the amount of $batch requests that may be sent concurrently for one mailbox"""
+        return max(int(self.env['ir.config_parameter'].sudo().get_param('office365.batch.concurrency', DEFAULT_BATCH_CONCURRENCY)), 1)
+
     # Perform Request
-    def aad_request(self, method, domain, data_id=None, data=None, link=None, url=None, headers=None, force=False):
-        """Performs a Request to the Azure AD Endpoint for the provided user."""
+    def aad_request(self, method, domain, data_id=None, data=None, link=None, url=None, headers=None, force=False, cost=1, scheduled=False):
+        """Performs a Request to the Azure AD Endpoint for the provided user.
+
+        scheduled means the caller already acquired the request slot, e.g. for a whole chunk of $batch requests."""
 
         # Create an item for future processing. If request was forced, execute it immediately
         if not force:
@@ -259,15 +460,11 @@ class AzureAdUser(models.Model):
             })
 
         # Get access token
-        try:
-            if not self.is_token_valid(self.access_token) and self.refresh_token:
-                self.set_access_token()
-        except Exception as e:
-            _logger.warning('Set token failed for user %s' % self.id)
+        self.prepare_access_token()
 
-            self.authentication_failure = True
-
-            raise e
+        # Wait for the request scheduler, don't send requests that would be throttled anyway
+        if not scheduled:
+            self.acquire_request_slot(cost)
 
         # Do request, raise exception if something went wrong
         response = self.do_http_method_request(method, self.form_url(url, domain, data_id, link, method), headers, data)
@@ -277,7 +474,69 @@ class AzureAdUser(models.Model):
         except ValueError:
             return_data = response.text
 
-        return self.process_response(AzureResponse(response.status_code, return_data, method, link))
+        return self.process_response(AzureResponse(response.status_code, return_data, method, link, headers=response.headers))
+
+    def prepare_access_token(self):
+        """Returns a valid access token for a request, flags the user when it can not be obtained"""
+        try:
+            return self.ensure_access_token()
+        except Exception as e:
+            _logger.warning('Set token failed for user %s' % self.id)
+
+            self.authentication_failure = True
+
+            raise e
+
+    # ----------
+    # Throttling
+    # ----------
+    @api.model
+    def get_throttle(self):
+        """Returns the request scheduler, configured with the system parameters"""
+        config = self.env['ir.config_parameter'].sudo()
+
+        return AzureAdThrottle(
+            mailbox_rate=float(config.get_param('office365.throttle.mailbox.rate', DEFAULT_MAILBOX_RATE)),
+            tenant_rate=float(config.get_param('office365.throttle.tenant.rate', DEFAULT_TENANT_RATE)),
+            max_wait=float(config.get_param('office365.throttle.max.wait', DEFAULT_MAX_WAIT)),
+            tenant_backoff=float(config.get_param('office365.throttle.tenant.backoff', DEFAULT_TENANT_BACKOFF)),
+        )
+
+    def get_throttle_keys(self):
+        """Returns the scheduler keys of the mailbox and of its tenant"""
+        self.ensure_one()
+        dbname = self.env.cr.dbname
+
+        return (dbname, 'user', self.id), (dbname, 'tenant', self.tenant_id or (self.email or '').rpartition('@')[2])
+
+    def check_throttled(self):
+        """Raises a RequestDeferredError while Outlook asked not to send requests for this mailbox"""
+        self.ensure_one()
+        now = fields.Datetime.now()
+
+        if self.throttled_until and self.throttled_until > now:
+            raise RequestDeferredError('Mailbox throttled until %s' % fields.Datetime.to_string(self.throttled_until), (self.throttled_until - now).total_seconds())
+
+    def acquire_request_slot(self, cost=1):
+        """Waits until the scheduler allows cost requests for this mailbox, raises a RequestDeferredError if it won't soon"""
+        self.check_throttled()
+
+        retry_after = self.get_throttle().acquire(*self.get_throttle_keys(), cost=cost)
+
+        if retry_after:
+            raise RequestDeferredError('Request scheduler limit reached, retry after %ss' % int(retry_after), retry_after)
+
+    def set_throttled(self, retry_after=None):
+        """Records that Outlook throttled this mailbox, the crons skip it until throttled_until"""
+        self.ensure_one()
+        retry_after = retry_after or DEFAULT_RETRY_AFTER
+
+        self.get_throttle().set_throttled(*self.get_throttle_keys(), retry_after)
+        self.throttled_until = fields.Datetime.now() + timedelta(seconds=retry_after)
+
+    @api.model
+    def get_not_throttled_domain(self):
+        return ['|', ('throttled_until', '=', False), ('throttled_until', '<=', fields.Datetime.now())]
 
     def process_response(self, response):
         try:
@@ -296,7 +555,12 @@ class AzureAdUser(models.Model):
                 pass
             else:
                 raise e
-        except (ThrottleError, AlreadyExistsError) as e:
+        except ThrottleError as e:
+            # Mailbox is throttled, stop sending requests until Outlook allows them again
+            self.set_throttled(e.retry_after)
+
+            raise e
+        except AlreadyExistsError as e:
             # Request failed because of errors not handled here, continue
             raise e
         except ParameterError as e:
@@ -325,7 +589,7 @@ class AzureAdUser(models.Model):
         return response.body
 
     def do_http_method_request(self, method, url, headers=None, data=None):
-        default_headers = {'Authorization': 'Bearer %s' % self.access_token}
+        default_headers = {'Authorization': 'Bearer %s' % (self.get_valid_access_token() or self.access_token)}
 
         # FOR DEBUGGING PURPOSE ONLY
         # print method, url, (data or '').replace('\n', '')
@@ -338,21 +602,33 @@ class AzureAdUser(models.Model):
             if headers:
                 default_headers.update(headers)
 
-            return requests.get(url, headers=default_headers)
+            return self.get_transport().request('GET', url, headers=default_headers)
         elif method == 'DELETE':
-            return requests.delete(url, headers=default_headers)
+            return self.get_transport().request('DELETE', url, headers=default_headers)
         elif method == 'POST':
             default_headers.update({'Content-Type': 'application/json'})
 
             if headers:
                 default_headers = dict(list(default_headers.items()) + list(headers.items()))
 
-            return requests.post(url, headers=default_headers, data=data)
+            return self.get_transport().request('POST', url, headers=default_headers, data=data)
         elif method == 'PATCH':
             default_headers.update({'Content-Type': 'application/json'})
-            return requests.patch(url, headers=default_headers, data=data)
+            return self.get_transport().request('PATCH', url, headers=default_headers, data=data)
         raise NotImplementedError('HTTP Method not Implemented: %s' % method)
 
+    @api.model
+    def get_transport(self):
+        """Returns the pooled HTTP transport, configured with the system parameters"""
+        config = self.env['ir.config_parameter'].sudo()
+
+        return AzureAdTransport(
+            pool_size=int(config.get_param('office365.http.pool.size', DEFAULT_POOL_SIZE)),
+            keep_alive=config.get_param('office365.http.keepalive', 'True') not in ['False', '0'],
+            connect_timeout=float(config.get_param('office365.http.timeout.connect', DEFAULT_CONNECT_TIMEOUT)),
+            read_timeout=float(config.get_param('office365.http.timeout.read', DEFAULT_READ_TIMEOUT)),
+        )
+
     # -------
     # Helpers
     # -------
@@ -415,17 +691,9 @@ class AzureAdUser(models.Model):
             return {}
     
     @api.model
-    def prepare_batch_request(self, method, url=None, domain=None, data_id=None, link=None, data=None):
-        body = "Content-Type: application/http\nContent-Transfer-Encoding: binary\n\n"
+    def prepare_batch_request(self, method, url=None, domain=None, data_id=None, link=None, data=None, select=None):
+        body = encode_batch_request(method, self.add_select(self.form_url(url, domain, data_id, link, method), select), data)
 
-        body += "%s %s HTTP/1.1\n" % (method, self.form_url(url, domain, data_id, link, method))
-        if data:
-            body += "Content-Type: application/json\n\n"
-        else:
-            body += "\n"
-        body += data or ''
-        body += "\n\n"
-        
         return BatchRequest(body=body, method=method, link=link)
 
     # JWT
@@ -463,20 +731,56 @@ class AzureAdUser(models.Model):
 
     @staticmethod
     def get_token_expiration_time(token):
-        """Returns the epoch expiration time"""
-        try:
-            return AzureAdUser.decode_jwt(token)['payload']['exp']
-        except AttributeError:
-            _logger.debug("Malformed jwt token: %s" % token)
-
+        """Returns the epoch expiration time, decoded tokens are cached per worker"""
+        if not token:
             return False
 
+        exp_time = _token_expiration_cache.get(token)
+
+        if exp_time is None:
+            try:
+                exp_time = AzureAdUser.decode_jwt(token)['payload']['exp']
+            except (AttributeError, ValueError, KeyError):
+                _logger.debug("Malformed jwt token: %s" % token)
+
+                exp_time = False
+
+            _token_expiration_cache.set(token, exp_time)
+
+        return exp_time
+
+    @staticmethod
+    def get_response_expiration_time(response):
+        """Returns the epoch expiration time of the access token in a token endpoint response"""
+        if response.get('expires_in'):
+            return int(time.time()) + int(response['expires_in'])
+
+        return AzureAdUser.get_token_expiration_time(response['access_token']) or 0
+
     @staticmethod
     def is_token_valid(token):
         exp_time = AzureAdUser.get_token_expiration_time(token)
 
         return exp_time and AzureAdUser.check_epoch_time_still_valid(exp_time)
 
+    @staticmethod
+    def add_select(url, select):
+        """Adds a $select projection to the url or domain, so only the listed properties are returned"""
+        if not url or not select:
+            return url
+
+        return '%s%s$select=%s' % (url, '&' if '?' in url else '?', ','.join(select))
+
+    @staticmethod
+    def extract_parent_data_id(domain, data_id=None):
+        """Returns the id of the parent resource of a domain like calendars/<id>/events, False if it has none"""
+        parts = (domain or '').split('/')
+
+        if len(parts) < 3:
+            return False
+
+        return (data_id if parts[1] == '%s' else parts[1]) or False
+
     @staticmethod
     def form_url(url, domain, data_id, link, method):
         """Forms the url used for the current request"""
@@ -535,7 +839,7 @@ class AzureAdUser(models.Model):
             raise ScopeError(message, response.status_code)
 
         if response.status_code in [429]:
-            raise ThrottleError(message, response.status_code)
+            raise ThrottleError(message, response.status_code, response.retry_after)
 
         if response.status_code in [500, 501, 503]:
             raise ServerError(message, response.status_code)
@@ -560,12 +864,28 @@ class AzureAdUser(models.Model):
     # ------------
     @api.model
     def refresh_access(self):
-        for user in self:
+        """Refreshes, ahead of expiry, the access tokens of the users that are synchronised"""
+        margin = int(self.env['ir.config_parameter'].sudo().get_param('office365.token.refresh.margin', DEFAULT_TOKEN_REFRESH_MARGIN))
+
+        users = self.search([
+            ('azure_ad_sync_started', '=', True),
+            ('authentication_failure', '=', False),
+            ('refresh_token', '!=', False),
+            '|', ('access_token_expiration', '=', False), ('access_token_expiration', '<', int(time.time()) + margin)
+        ])
+
+        commit = not (self.env.registry.in_test_mode() or getattr(threading.current_thread(), 'testing', False))
+
+        for user in users:
             try:
-                user.set_access_token()
+                user.ensure_access_token(margin=margin)
             except:
                 pass
 
+            # Release the refresh lock and store the token of every user on its own
+            if commit:
+                self.env.cr.commit()
+
     # -----------
     # Overridable
     # -----------
@@ -611,12 +931,31 @@ class BatchRequest:
     
     
 class AzureResponse:
-    def __init__(self, status_code, body, method, link=None):
+    def __init__(self, status_code, body, method, link=None, headers=None):
         self.link = link
         self.method = method
         self.status_code = status_code
+        self.headers = headers or {}
 
         try:
             self.body = json.loads(body)
         except:
             self.body = body
+
+    @property
+    def retry_after(self):
+        """Returns the seconds to wait given by the Retry-After header, if any"""
+        value = self.headers.get('Retry-After')
+
+        if not value:
+            return None
+
+        try:
+            return max(int(value), 0)
+        except ValueError:
+            pass
+
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            return None
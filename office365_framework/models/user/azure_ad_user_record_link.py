@@ -1,11 +1,12 @@
 # See LICENSE file for full copyright and licensing details.
-import json
 import logging
 
-from odoo import fields, models, api
+from odoo import fields, models, api, tools
 
 from odoo.fields import Reference
 
+from ..fields import split_reference
+
 _logger = logging.getLogger(__name__)
 
 
@@ -16,8 +17,13 @@ class AzureAdUserRecordLink(models.Model):
     data_domain = fields.Char(string="Azure AD Access Domain")
     data_id = fields.Char(string="Azure AD ID")
     create_domain = fields.Char(string="Azure AD Create Domain")
+    parent_data_id = fields.Char(string="Azure AD Parent ID", index=True, help='Id of the parent resource in the create domain, e.g. the calendar of calendars/<id>/events')
+    sent_hash = fields.Char(string="Hash of the Last Pushed Content")
+    applied_hash = fields.Char(string="Hash of the Last Pulled Content")
     push_queue_ids = fields.One2many(comodel_name='azure.ad.push.queue.item', string='Push Queue Items', inverse_name='link')
     record = Reference(string="Reference", selection='_select_objects')
+    res_model = fields.Char(string="Record Model")
+    res_id = fields.Integer(string="Record Id", help='Id of the real record, occurrences of virtual records share it')
     sync_type = fields.Selection(string="Sync Way", default='both', selection=[
         ('both', 'Odoo <-> Azure'),
         ('o2a',  'Odoo --> Azure'),
@@ -25,6 +31,14 @@ class AzureAdUserRecordLink(models.Model):
         ('none', 'Odoo -/- Azure (Handled by other link)'),
     ])
 
+    _sql_constraints = [
+        ('user_record_uniq', 'unique(user_id, record)', 'A user can only have one link per record'),
+    ]
+
+    def init(self):
+        tools.create_index(self._cr, 'azure_ad_user_record_link_res_model_res_id_index', self._table, ['res_model', 'res_id'])
+        tools.create_index(self._cr, 'azure_ad_user_record_link_user_id_data_id_index', self._table, ['user_id', 'data_id'])
+
     @api.model
     def _select_objects(self):
         records = self.env['ir.model'].search([])
@@ -39,21 +53,20 @@ class AzureAdUserRecordLink(models.Model):
             if link.sync_type in ['none', 'a2o']:
                 continue
 
-            prev = self.env['azure.ad.push.queue.item'].search([('link', '=', link.id), ('status', 'in', ['waiting', 'retrying']), ('method', 'in', ['PATCH', 'POST', 'DELETE'])])
-
-            if prev and prev[0].method in ['POST', 'PATCH']:
-                # Merge multilevel dictionaries
-                prev.data = json.dumps(self.merge(json.loads(prev[0].data), change))
-            elif prev and prev[0].method == 'DELETE':
-                return False
-            else:
-                link.user_id.patch_data(domain=link.data_domain, data_id=link.data_id, data=change, link=link)
+            # Pending items of the link are coalesced when the queue is pushed
+            link.user_id.patch_data(domain=link.data_domain, data_id=link.data_id, data=change, link=link)
 
     @api.model
     def create(self, vals):
         data = vals.pop('data') if 'data' in vals else None
 
-        res = self.search([('record', '=', vals['record']), ('user_id', '=', vals['user_id'])])
+        if 'create_domain' in vals and 'parent_data_id' not in vals:
+            vals['parent_data_id'] = self.env['azure.ad.user'].extract_parent_data_id(vals['create_domain'], vals.get('data_id'))
+
+        if 'record' in vals:
+            vals['res_model'], vals['res_id'] = split_reference(vals['record'])
+
+        res = self.search(self.get_reference_domain(vals['record']) + [('user_id', '=', vals['user_id'])])
 
         if not res:
             res = super(AzureAdUserRecordLink, self).create(vals)
@@ -69,6 +82,15 @@ class AzureAdUserRecordLink(models.Model):
 
         return res
 
+    def write(self, vals):
+        if 'record' in vals:
+            vals['res_model'], vals['res_id'] = split_reference(vals['record'])
+
+        if 'create_domain' in vals and 'parent_data_id' not in vals:
+            vals['parent_data_id'] = self.env['azure.ad.user'].extract_parent_data_id(vals['create_domain'], vals.get('data_id'))
+
+        return super(AzureAdUserRecordLink, self).write(vals)
+
     def delete(self):
         for link in self:
             # If link only syncs from azure to odoo, remove it without deleting data in azure
@@ -77,12 +99,37 @@ class AzureAdUserRecordLink(models.Model):
             else:
                 # Remove pushes in queue
                 link.push_queue_ids.unlink()
+
+                # Never created in Azure, nothing to delete
+                if not link.data_id:
+                    link.unlink()
+                    continue
+
                 # Make a deletion request
                 link.user_id.delete_data(domain=link.data_domain, data_id=link.data_id, link=link)
 
     # -------
     # HELPERS
     # -------
+    def get_in_sync_hash(self):
+        """Returns the hash of the content last known to be the same in Odoo and Outlook.
+
+        Only one of sent_hash and applied_hash is set at a time, the one of the last push or pull, so content reverted
+        to an older version is not mistaken for an echo"""
+        self.ensure_one()
+
+        return self.sent_hash or self.applied_hash
+
+    @api.model
+    def get_reference_domain(self, reference):
+        """Domain of the links of exactly this 'model,id' reference, probes the (res_model, res_id) index"""
+        if not isinstance(reference, str):
+            reference = '%s,%s' % (reference._name, reference.id)
+
+        res_model, res_id = split_reference(reference)
+
+        return [('res_model', '=', res_model), ('res_id', '=', res_id), ('record', '=', reference)]
+
     def merge(self, data_1, data_2):
         """Merges dictionaries with sub arrays, works recursively"""
         try: